@@ -0,0 +1,188 @@
+"""Headless HTTP API over the request engine.
+
+The Streamlit UI needs a browser and reruns its script on every interaction. This
+API serves the same actions to scripts, CI jobs and pre-commit hooks through the
+same engine functions, so it shares the process's response cache, rate limiter and
+metrics. It runs on tornado, which ships with Streamlit, and keeps no state of its
+own, so instances can be scaled out behind a load balancer:
+
+    python -m cli serve --port 8080
+
+Endpoints, all taking and returning JSON:
+  GET  /healthz
+  POST /v1/<command>  {"code": ..., "task_description": ..., "sys_prompt": ..., "stream": false}
+       command is one of engine.COMMANDS: prompt, analyze, explain or readme.
+       Returns {"feedback": ..., "code": ...}. With "stream": true the response is
+       newline-delimited JSON: each line holds the feedback and code added since the
+       previous line (both in full when "replace" is true), and the last line holds
+       the complete result with "done": true, or "error".
+  POST /v1/batch      {"command": ..., "files": {name: code}, "task_description": ..., "sys_prompt": ...}
+       Newline-delimited JSON, one {"file", "feedback", "code", "error"} line per file
+       as each completes.
+
+When API_TOKEN is set, requests other than /healthz must send it in an
+"Authorization: Bearer <token>" header.
+"""
+import asyncio
+import hmac
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+from typing import Tuple
+
+import tornado.web
+from tornado.iostream import StreamClosedError
+
+import engine
+import metrics
+import token_budget
+
+API_PORT = int(os.getenv("API_PORT", "8080"))
+API_TOKEN = os.getenv("API_TOKEN", "")
+# Requests processed at once per process; the rate limiter still holds them to the quota
+API_WORKERS = int(os.getenv("API_WORKERS", "16"))
+
+# The engine's request functions block, so they run on this pool instead of the event loop
+_pool = ThreadPoolExecutor(max_workers=max(1, API_WORKERS), thread_name_prefix="api")
+
+
+def parse_request(command: str, body: dict) -> Tuple[str, str, str]:
+    """Return (action, system prompt, task description) for a request, raising a 4xx HTTPError if invalid."""
+    action = engine.COMMANDS.get(command)
+    if action is None:
+        raise tornado.web.HTTPError(404, reason=f"Unknown command, use one of: {', '.join(engine.COMMANDS)}")
+    for field in ("task_description", "sys_prompt", "code"):
+        if not isinstance(body.get(field) or "", str):
+            raise tornado.web.HTTPError(400, reason=f"{field} must be a string")
+    task_description = (body.get("task_description") or "").strip() or engine.ACTIONS[action]["default_task"]
+    return action, body.get("sys_prompt") or engine.DEFAULT_SYS_PROMPT, task_description
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    def prepare(self):
+        if API_TOKEN and not hmac.compare_digest(self.request.headers.get("Authorization", ""),
+                                                 f"Bearer {API_TOKEN}"):
+            raise tornado.web.HTTPError(401, reason="Missing or invalid API token")
+
+    def write_error(self, status_code: int, **kwargs):
+        self.finish({"error": self._reason})
+
+    def json_body(self) -> dict:
+        try:
+            body = json.loads(self.request.body or b"{}")
+        except ValueError:
+            body = None
+        if not isinstance(body, dict):
+            raise tornado.web.HTTPError(400, reason="The request body must be a JSON object")
+        return body
+
+    async def write_line(self, data: dict):
+        """Send one line of newline-delimited JSON to the client right away."""
+        self.write(json.dumps(data) + "\n")
+        await self.flush()
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.finish({"status": "ok"})
+
+
+class ActionHandler(BaseHandler):
+    async def post(self, command: str):
+        body = self.json_body()
+        action, sys_prompt, task_description = parse_request(command, body)
+        code = "" if action == "Submit Prompt" else body.get("code") or ""
+        if action != "Submit Prompt" and not code.strip():
+            raise tornado.web.HTTPError(400, reason="code is required")
+
+        if body.get("stream"):
+            await self.stream_action(action, sys_prompt, task_description, code)
+            return
+        try:
+            feedback, refined_code = await asyncio.get_running_loop().run_in_executor(
+                _pool, engine.run_chunked, action, sys_prompt, task_description, code
+            )
+        except token_budget.PromptTooLargeError as e:
+            raise tornado.web.HTTPError(413, reason=str(e))
+        except Exception as e:
+            print(f"API request for {action} failed: {e}")
+            self.set_status(502)
+            self.finish({"error": f"Error calling Azure OpenAI API: {e}"})
+            return
+        self.finish({"feedback": feedback, "code": refined_code})
+
+    async def stream_action(self, action: str, sys_prompt: str, task_description: str, code: str):
+        """Send the response as newline-delimited JSON while it is generated."""
+        loop = asyncio.get_running_loop()
+        updates = asyncio.Queue()
+
+        def on_update(feedback: str, refined_code: str):
+            loop.call_soon_threadsafe(updates.put_nowait, (feedback, refined_code))
+
+        future = loop.run_in_executor(_pool, engine.run_chunked, action, sys_prompt, task_description,
+                                      code, on_update)
+        future.add_done_callback(lambda _: updates.put_nowait(None))
+
+        self.set_header("Content-Type", "application/x-ndjson")
+        sent_feedback, sent_code = "", ""
+        try:
+            while True:
+                update = await updates.get()
+                if update is None:
+                    break
+                feedback, refined_code = update
+                if (feedback, refined_code) == (sent_feedback, sent_code):
+                    continue
+                if feedback.startswith(sent_feedback) and refined_code.startswith(sent_code):
+                    line = {"feedback": feedback[len(sent_feedback):], "code": refined_code[len(sent_code):]}
+                else:
+                    line = {"feedback": feedback, "code": refined_code, "replace": True}
+                await self.write_line(line)
+                sent_feedback, sent_code = feedback, refined_code
+            try:
+                feedback, refined_code = future.result()
+                await self.write_line({"feedback": feedback, "code": refined_code, "done": True})
+            except Exception as e:
+                print(f"API request for {action} failed: {e}")
+                await self.write_line({"error": f"Error calling Azure OpenAI API: {e}", "done": True})
+        except StreamClosedError:
+            # The client went away; the request still completes and fills the response cache
+            return
+        self.finish()
+
+
+class BatchHandler(BaseHandler):
+    async def post(self):
+        body = self.json_body()
+        action, sys_prompt, task_description = parse_request(body.get("command") or "", body)
+        files = body.get("files")
+        if (not isinstance(files, dict) or not files
+                or not all(isinstance(code, str) for code in files.values())):
+            raise tornado.web.HTTPError(400, reason="files must map file names to source text")
+
+        self.set_header("Content-Type", "application/x-ndjson")
+        try:
+            async with aclosing(engine.run_batch(action, sys_prompt, task_description, files)) as results:
+                async for name, feedback, refined_code, error in results:
+                    await self.write_line({"file": name, "feedback": feedback, "code": refined_code, "error": error})
+        except StreamClosedError:
+            # Closing the batch cancels the files that are still running
+            return
+        self.finish()
+
+
+def make_app() -> tornado.web.Application:
+    return tornado.web.Application([
+        (r"/healthz", HealthHandler),
+        (r"/v1/batch", BatchHandler),
+        (r"/v1/([a-z]+)", ActionHandler),
+    ])
+
+
+async def serve(port: int = API_PORT, address: str = "0.0.0.0"):
+    """Serve the API until the process is stopped."""
+    metrics.start_server()
+    make_app().listen(port, address)
+    print(f"API available on http://{address}:{port}")
+    await asyncio.Event().wait()
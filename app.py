@@ -1,398 +1,186 @@
-from typing import Tuple
-import sys
-from io import StringIO
-import contextlib
-import traceback
-import re
+from typing import Dict, Optional
+import asyncio
+import io
+import zipfile
 import time
-import os
 import streamlit as st
-from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
-# import openai
-from openai import AzureOpenAI
-from azure.search.documents import SearchClient, IndexDocumentsBatch
-from azure.search.documents.indexes import SearchIndexerClient
-from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential
-from dotenv import load_dotenv
-
-
-load_dotenv()
-# Azure OpenAI configuration
-endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-model = os.getenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT")
-api_key = os.getenv("AZURE_OPENAI_KEY")
-api_version = os.getenv("AZURE_OPENAI_API_VERSION")
-
-print("Azure OpenAI API initialized")
-client = AzureOpenAI(
-    azure_endpoint = endpoint,
-    api_key = api_key,
-    api_version = api_version
-)
-
-# Azure Storage Account connection string
-STORAGE_ACCOUNT_NAME = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
-CONTAINER_NAME = os.getenv("CONTAINER_NAME")
-ACCOUNT_URL: str = f"https://{STORAGE_ACCOUNT_NAME}.blob.core.windows.net"
-# print(f"Account URL: {ACCOUNT_URL}")
-
-# Initialize Azure Blob Service Client
-credential = DefaultAzureCredential()
-blob_service_client = BlobServiceClient(account_url=f"https://{STORAGE_ACCOUNT_NAME}.blob.core.windows.net", credential=credential)
-container_client = blob_service_client.get_container_client(CONTAINER_NAME)
-
-# Azure Search configuration
-search_endpoint = os.getenv("AZURE_AI_SEARCH_ENDPOINT")
-search_key = os.getenv("AZURE_AI_SEARCH_KEY")
-search_index = os.getenv("AZURE_AI_SEARCH_INDEX")
-search_indexer = os.getenv("AZURE_AI_SEARCH_INDEXER")
-
-# Initialize Azure Search Client
-search_client = SearchClient(endpoint=search_endpoint, index_name=search_index, credential=AzureKeyCredential(search_key))
-indexer_client = SearchIndexerClient(endpoint=search_endpoint, credential=AzureKeyCredential(search_key))
+import clients
+import conversation
+import engine
+import router
+import response_cache
+import retrieval
+import indexing
+import jobs
+import metrics
+import storage
 
 if 'sys_prompt' not in st.session_state:
-    st.session_state.sys_prompt = "You are an assistant to a programmer, in responses only provide code when asked to convert.  When asked to explain, provide detailed explanation that is technical in depth" 
+    st.session_state.sys_prompt = engine.DEFAULT_SYS_PROMPT
 
 # Function to change the variable
 def change_global_var(value):
     st.session_state.sys_prompt = value
 
-@contextlib.contextmanager
-def capture_output():
-    """Capture stdout and stderr"""
-    new_out, new_err = StringIO(), StringIO()
-    old_out, old_err = sys.stdout, sys.stderr
-    try:
-        sys.stdout, sys.stderr = new_out, new_err
-        yield sys.stdout, sys.stderr
-    finally:
-        sys.stdout, sys.stderr = old_out, old_err
-
+def run_action(action: str, task_description: str, code: str, stream: bool = False) -> Optional[str]:
+    """Start an action in the background and return its job ID, reporting errors in the UI.
 
-def submit_prompt(task_description: str) -> Tuple[str, str]:
-    """Process the code using Azure OpenAI API and return feedback and refined code."""
-    prompt = f"""
-Task Description: {task_description}
+    Code over the chunk budget is split, analyzed in parallel and merged by the engine.
+    In conversation mode the job sends the earlier turns as history; the turn is
+    recorded when the job finishes.
+    """
+    try:
+        session = st.session_state.conversation if st.session_state.get('conversation_mode') else None
+        job_id = jobs.get_queue().submit(action, st.session_state.sys_prompt, task_description, code,
+                                         session, stream)
+    except Exception as e:
+        st.error(f"Error calling Azure OpenAI API: {e}")
+        return None
+    # The job ID in the URL lets a reloaded page reattach to the job
+    st.session_state.job_id = job_id
+    st.session_state.job_error = ""
+    st.session_state.feedback = ""
+    st.session_state.refined_code = ""
+    st.query_params["job"] = job_id
+    return job_id
 
-Please provide:
-1. A detailed technical response
-2. Expert written code if asked to generate code 
 
+def submit_prompt(task_description: str, stream: bool = False) -> Optional[str]:
+    """Process the prompt using Azure OpenAI API in the background and return the job ID."""
+    print("st.session_state.sys_prompt", st.session_state.sys_prompt)
+    return run_action("Submit Prompt", task_description, "", stream)
 
-Format your response exactly as follows:
----FEEDBACK---
-[Your feedback here]
----CODE---
-[The generated code here without any markdown formatting or additional explanation within the code section]
-"""
-    try:
-        print("st.session_state.sys_prompt", st.session_state.sys_prompt)
-        message = client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": st.session_state.sys_prompt
-                },
-                {
-                    "role": "user", 
-                    "content": prompt
-                }
-            ], 
-            max_tokens=8000,
-            temperature=0,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-            stop=None,
-            stream=False,
-            extra_body={
-                "data_sources": [
-                    {
-                        "type": "azure_search",
-                        "parameters": {
-                            "endpoint": search_endpoint,
-                            "index_name": search_index,
-                            "semantic_configuration": "default",
-                            "query_type": "simple",
-                            "fields_mapping": {},
-                            "in_scope": True,
-                            "filter": None,
-                            "strictness": 3,
-                            "top_n_documents": 5,
-                            "authentication": {
-                                "type": "api_key",
-                                "key": search_key
-                            }
-                        }
-                    }
-                ]
-            }
-        )
 
-        # print("Message: ", message)
-        content = message.choices[0].message.content
-        # Extract feedback and code
-        feedback_match = re.search(r"---FEEDBACK---(.*?)---CODE---", content, re.DOTALL)
-        code_match = re.search(r"---CODE---(.*)", content, re.DOTALL)
+def analyze_code(task_description: str, code: str, stream: bool = False) -> Optional[str]:
+    """Analyze the code using Azure OpenAI API in the background and return the job ID."""
+    return run_action("Analyze Code", task_description, code, stream)
 
-        if feedback_match and code_match:
-            feedback = feedback_match.group(1).strip()
-            refined_code = code_match.group(1).strip()
-            return feedback, refined_code
-        else:
-            return content, ""
-    except Exception as e:
-        st.error(f"Error calling Azure OpenAI API: {e}")
-        return "", ""
-
-
-def analyze_code(task_description: str, code: str) -> Tuple[str, str]:
-    """Analyze the code using Azure OpenAI API and return feedback and refined code."""
-    prompt = f"""
-
-Task Description: {task_description}
-
-
-Original Code:
-```python
-{code}
-```
-Please provide:
-1. A detailed code review and feedback
-2. A refined version of the code that implements the requested changes
-3. Make sure the code doesn't require user input and uses test cases instead
-4. Prefer using emoji-based output over terminal colors for better compatibility
-5. If using colors, use only standard print statements or emojis
-6. If asked, explain the code in detail
-
-Format your response exactly as follows:
----FEEDBACK---
-[Your feedback here]
----CODE---
-[The refined code here without any markdown formatting or additional explanation within the code section]
-"""
-    try:
-        message = client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": st.session_state.sys_prompt
-                },
-                {
-                    "role": "user", 
-                    "content": prompt
-                }
-            ], 
-            max_tokens=8000,
-            temperature=0,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-            stop=None,
-            stream=False,
-            extra_body={
-                "data_sources": [
-                    {
-                        "type": "azure_search",
-                        "parameters": {
-                            "endpoint": search_endpoint,
-                            "index_name": search_index,
-                            "semantic_configuration": "default",
-                            "query_type": "simple",
-                            "fields_mapping": {},
-                            "in_scope": True,
-                            "filter": None,
-                            "strictness": 3,
-                            "top_n_documents": 5,
-                            "authentication": {
-                                "type": "api_key",
-                                "key": search_key
-                            }
-                        }
-                    }
-                ]
-            }
-        )
-        # print("Message: ", message)
-        content = message.choices[0].message.content
-        # Extract feedback and code
-        feedback_match = re.search(r"---FEEDBACK---(.*?)---CODE---", content, re.DOTALL)
-        code_match = re.search(r"---CODE---(.*)", content, re.DOTALL)
-
-        if feedback_match and code_match:
-            feedback = feedback_match.group(1).strip()
-            refined_code = code_match.group(1).strip()
-            return feedback, refined_code
-        else:
-            return content, ""
-    except Exception as e:
-        st.error(f"Error calling Azure OpenAI API: {e}")
-        return "", ""
 
-def explain_code(task_description: str, code: str) -> Tuple[str, str]:
+def explain_code(task_description: str, code: str, stream: bool = False) -> Optional[str]:
+    """Explain the code using Azure OpenAI API in the background and return the job ID."""
     print("Taskdescription: ", task_description)
-    """Process the code using Azure OpenAI API and return feedback and refined code."""
-    prompt = f"""
-Task Description: {task_description}
-
-
-Original Code:
-```python
-{code}
-```
-Please provide:
-1. A detailed code explanation
-2. Explain line by line the code and what it does
-3. Offer suggestions for improvement
-4. Provide examples of how the code can be used
-
-
-Format your response exactly as follows:
----FEEDBACK---
-[Your feedback here]
----CODE---
-[The refined code here without any markdown formatting or additional explanation within the code section]
-"""
-    try:
-        message = client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": st.session_state.sys_prompt
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            max_tokens=8000,
-            temperature=0,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-            stop=None,
-            stream=False,
-            extra_body={
-                "data_sources": [
-                    {
-                        "type": "azure_search",
-                        "parameters": {
-                            "endpoint": search_endpoint,
-                            "index_name": search_index,
-                            "semantic_configuration": "default",
-                            "query_type": "simple",
-                            "fields_mapping": {},
-                            "in_scope": True,
-                            "filter": None,
-                            "strictness": 3,
-                            "top_n_documents": 5,
-                            "authentication": {
-                                "type": "api_key",
-                                "key": search_key
-                            }
-                        }
-                    }
-                ]
-            }
-        )
-        # print("Message: ", message)
-        content = message.choices[0].message.content
-        # Extract feedback and code
-        feedback_match = re.search(r"---FEEDBACK---(.*?)---CODE---", content, re.DOTALL)
-        code_match = re.search(r"---CODE---(.*)", content, re.DOTALL)
-
-        if feedback_match and code_match:
-            feedback = feedback_match.group(1).strip()
-            refined_code = code_match.group(1).strip()
-            return feedback, refined_code
+    return run_action("Explain Code", task_description, code, stream)
+
+
+def create_readme(code: str, stream: bool = False) -> Optional[str]:
+    """Generate a README for the code using Azure OpenAI API in the background and return the job ID."""
+    return run_action("Create README", "", code, stream)
+
+
+def finish_job(job: dict):
+    """Move a finished job's output into the session and record the conversation turn."""
+    st.session_state.job_id = None
+    st.query_params.pop("job", None)
+    if job["status"] == "error":
+        st.session_state.job_error = job["error"]
+        return
+    st.session_state.feedback = job["feedback"]
+    st.session_state.refined_code = job["refined_code"]
+    if st.session_state.get('conversation_mode') and (job["feedback"] or job["refined_code"]):
+        st.session_state.conversation.add_turn(job["action"], job["task_description"], job["code"],
+                                               job["feedback"], job["refined_code"])
+
+
+@st.fragment(run_every=jobs.JOB_POLL_SECONDS)
+def job_output():
+    """Show the partial output of the session's job until it finishes, then rerun the app with the result."""
+    job = jobs.get_queue().get(st.session_state.job_id)
+    if job is None:
+        st.session_state.job_id = None
+        st.query_params.pop("job", None)
+        st.session_state.job_error = "The job was not found, it may have expired or run in another worker"
+        st.rerun()
+    if job["status"] in jobs.FINISHED:
+        finish_job(job)
+        st.rerun()
+    st.caption(f"{job['action']} {job['status']}...")
+    if job["feedback"]:
+        st.markdown(job["feedback"])
+    if job["refined_code"]:
+        st.code(job["refined_code"], language='python')
+
+
+def read_batch_files(uploaded_files) -> Dict[str, str]:
+    """Return {file name: source text} for the uploaded files, expanding .zip archives."""
+    contents = {}
+    for uploaded_file in uploaded_files or []:
+        if uploaded_file.name.lower().endswith(".zip"):
+            with zipfile.ZipFile(io.BytesIO(uploaded_file.getvalue())) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir():
+                        contents[f"{uploaded_file.name}/{info.filename}"] = archive.read(info)
         else:
-            return content, ""
-    except Exception as e:
-        st.error(f"Error calling Azure OpenAI API: {e}")
-        return "", ""
-
-def create_readme(code: str) -> Tuple[str, str]:
-    """Process the code using Azure OpenAI API and return feedback and refined code."""
-    prompt = f"""
-
-Original Code:
-```python
-{code}
-```
-Please:
-1. Create a well formatted readme.md file that is comprehensive and easy to understand
-2. Describe purpose of code
-3. Details about prerequisites, installation, usage, and examples
-
-Format your response exactly as follows:
----FEEDBACK---
-[Your feedback here]
----CODE---
-[The refined code here without any markdown formatting or additional explanation within the code section]
-"""
+            contents[uploaded_file.name] = uploaded_file.getvalue()
+
+    files = {}
+    for name, data in contents.items():
+        try:
+            text = data.decode("utf-8")
+        except UnicodeDecodeError:
+            print(f"Skipping binary file {name}")
+            continue
+        if text.strip():
+            files[name] = text
+    return files
+
+
+@st.fragment(run_every=indexing.INDEXER_POLL_SECONDS)
+def indexer_status():
+    """Show the search indexer status, refreshed in the background."""
+    trigger = indexing.get_trigger()
+    if trigger.scheduled_at:
+        st.caption(f"Indexer run scheduled in {max(0, trigger.scheduled_at - time.time()):.0f}s")
+    if trigger.last_error:
+        st.caption(f"Indexer error: {trigger.last_error}")
+    if trigger.last_status is None and trigger.scheduled_at is None:
+        return
     try:
-        message = client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": st.session_state.sys_prompt
-                },
-                {
-                    "role": "user", 
-                    "content": prompt
-                }
-            ],
-            max_tokens=8000,
-            temperature=0,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-            stop=None,
-            stream=False,
-            extra_body={
-                "data_sources": [
-                    {
-                        "type": "azure_search",
-                        "parameters": {
-                            "endpoint": search_endpoint,
-                            "index_name": search_index,
-                            "semantic_configuration": "default",
-                            "query_type": "simple",
-                            "fields_mapping": {},
-                            "in_scope": True,
-                            "filter": None,
-                            "strictness": 3,
-                            "top_n_documents": 5,
-                            "authentication": {
-                                "type": "api_key",
-                                "key": search_key
-                            }
-                        }
-                    }
-                ]
-            }
-        )
-        # print("Message: ", message)
-        content = message.choices[0].message.content
-        # Extract feedback and code
-        feedback_match = re.search(r"---FEEDBACK---(.*?)---CODE---", content, re.DOTALL)
-        code_match = re.search(r"---CODE---(.*)", content, re.DOTALL)
-
-        if feedback_match and code_match:
-            feedback = feedback_match.group(1).strip()
-            refined_code = code_match.group(1).strip()
-            return feedback, refined_code
-        else:
-            return content, ""
+        status = trigger.status()
     except Exception as e:
-        st.error(f"Error calling Azure OpenAI API: {e}")
-        return "", ""
+        st.caption(f"Indexer status unavailable: {e}")
+        return
+    if status["running"]:
+        st.caption(f"Indexer running: {status['items']} items processed")
+    elif status["last_result"]:
+        st.caption(
+            f"Indexer {status['last_result']}: {status['items']} items, "
+            f"{status['failed_items']} failed"
+        )
+
+
+@st.fragment(run_every=metrics.PANEL_REFRESH_SECONDS)
+def metrics_panel():
+    """Show latency percentiles and token usage per action, refreshed in the background."""
+    rows = metrics.recorder.summary()
+    if not rows:
+        st.caption("No requests yet")
+        return
+    st.dataframe(rows, hide_index=True, use_container_width=True)
+    if metrics.METRICS_PORT:
+        st.caption(f"Prometheus metrics on port {metrics.METRICS_PORT} at /metrics")
+
+
+def render_batch_result(container, name: str, feedback: str, refined_code: str, error: str):
+    with container.expander(name, expanded=False):
+        if error:
+            st.error(f"Error calling Azure OpenAI API: {error}")
+        if feedback:
+            st.markdown(feedback)
+        if refined_code:
+            st.code(refined_code, language='python')
+
+
+async def run_batch(action: str, task_description: str, files: Dict[str, str], container):
+    """Run an action over the batch files, rendering each result as soon as it completes."""
+    progress = container.progress(0.0, text=f"0 / {len(files)} files")
+    st.session_state.batch_results = {}
+    async for name, feedback, refined_code, error in engine.run_batch(
+        action, st.session_state.sys_prompt, task_description, files
+    ):
+        st.session_state.batch_results[name] = (feedback, refined_code, error)
+        render_batch_result(container, name, feedback, refined_code, error)
+        done = len(st.session_state.batch_results)
+        progress.progress(done / len(files), text=f"{done} / {len(files)} files")
 
 
 def main():
@@ -407,47 +195,127 @@ def main():
     # Move the action selector to the top
     selected_action = st.selectbox(
         "Select an action:",
-        ["Analyze Code", "Create README", "Explain Code", "Submit Prompt"]
+        engine.ACTION_NAMES
     )
 
 
     # Initialize session state
     if 'api_key' not in st.session_state:
         # Try to get API key from environment variables first
-        st.session_state.api_key = os.getenv("AZURE_OPENAI_KEY")
+        st.session_state.api_key = clients.api_key
     if 'run_clicked' not in st.session_state:
         st.session_state.run_clicked = False
+    if 'conversation' not in st.session_state:
+        st.session_state.conversation = conversation.Conversation()
+    if 'job_id' not in st.session_state:
+        # A new session reattaches to the job in the URL, such as after a page reload
+        st.session_state.job_id = st.query_params.get("job")
+    metrics.start_server()
     
     with st.sidebar:
         # File uploader
-        uploaded_file = st.file_uploader("Choose a file")
-
-        if uploaded_file is not None:
-            # Save the uploaded file to a temporary location
-            with open(uploaded_file.name, "wb") as f:
-                f.write(uploaded_file.getbuffer())
-            
-            # Upload the file to Azure Storage
-            blob_client = container_client.get_blob_client(uploaded_file.name)
-            with open(uploaded_file.name, "rb") as data:
-                try:
-                    blob_client.upload_blob(data, overwrite=True)
+        uploaded_files = st.file_uploader("Choose files", accept_multiple_files=True)
+
+        # Uploaded files stay in the widget across reruns, so only send new ones
+        if 'uploaded_file_ids' not in st.session_state:
+            st.session_state.uploaded_file_ids = set()
+        new_files = [f for f in uploaded_files or [] if f.file_id not in st.session_state.uploaded_file_ids]
+        if new_files:
+            with st.spinner(f"Uploading {len(new_files)} file(s) to Azure Storage..."):
+                results = storage.upload_files({f.name: f.getbuffer() for f in new_files})
+            for uploaded_file in new_files:
+                result = results[uploaded_file.name]
+                if result == "uploaded":
                     st.success(f"File {uploaded_file.name} uploaded to Azure Storage successfully!")
-                except Exception as e:
-                    st.error(f"Error uploading file: {e}")
-                    st.stop()
+                elif result == "unchanged":
+                    st.info(f"File {uploaded_file.name} is already up to date in Azure Storage")
+                else:
+                    st.error(f"Error uploading file {uploaded_file.name}: {result}")
+                    continue
+                st.session_state.uploaded_file_ids.add(uploaded_file.file_id)
 
-            # Delete the local copy of the file
-            os.remove(uploaded_file.name)
+            changed = {f.name: f.getbuffer() for f in new_files if results[f.name] == "uploaded"}
+            if changed and indexing.INCREMENTAL_INDEXING:
+                try:
+                    with st.spinner("Indexing uploaded files..."):
+                        indexed = indexing.index_files(changed)
+                    st.success(f"Indexed {sum(indexed.values())} chunks from {len(indexed)} file(s)")
+                except Exception as e:
+                    st.error(f"Error indexing files: {e}")
+            elif changed:
+                indexing.get_trigger().request()
+                st.info(f"Re-indexing scheduled in {indexing.INDEXER_DEBOUNCE_SECONDS:.0f}s")
+            if changed and retrieval.LOCAL_RETRIEVAL:
+                try:
+                    local_files = read_batch_files([f for f in new_files if f.name in changed])
+                    retrieval.get_index().replace_files(local_files)
+                    st.success(f"Added {len(local_files)} file(s) to the local index")
+                except Exception as e:
+                    st.error(f"Error updating the local index: {e}")
 
         if st.button("Re-index Data"):
-            try:
-                indexer_client.run_indexer(search_indexer)
-                st.success("Re-indexing triggered successfully!")
-            except Exception as e:
-                st.error(f"Error triggering re-indexing: {e}")
+            # Debounced so that clicks from several sessions share one indexer run
+            indexing.get_trigger().request()
+            st.success(f"Re-indexing scheduled in {indexing.INDEXER_DEBOUNCE_SECONDS:.0f}s")
+
+        indexer_status()
+
+        if retrieval.LOCAL_RETRIEVAL:
+            if st.button("Rebuild Local Index"):
+                try:
+                    with st.spinner("Building the local index from Azure Storage..."):
+                        chunks = retrieval.rebuild_index()
+                    st.success(f"Local index rebuilt with {chunks} chunks")
+                except Exception as e:
+                    st.error(f"Error building the local index: {e}")
+            st.caption(f"Local index: {len(retrieval.get_index())} chunks")
 
         
+        stream_output = st.checkbox(
+            "Stream output",
+            value=True,
+            help="Show the response as it is generated instead of waiting for the full completion"
+        )
+
+        st.checkbox(
+            "Conversation mode",
+            value=False,
+            key="conversation_mode",
+            help="Send earlier requests and responses with follow-ups, so code doesn't need to be pasted again"
+        )
+        if st.session_state.conversation_mode:
+            session = st.session_state.conversation
+            if st.button("New Conversation"):
+                session = st.session_state.conversation = conversation.Conversation()
+            st.caption(
+                f"Conversation: {len(session)} turns, {session.summarized_turns} summarized"
+            )
+
+        cache_stats = response_cache.get_cache().stats()
+        st.caption(
+            f"Response cache ({cache_stats['backend']}): {cache_stats['entries']} entries, "
+            f"{cache_stats['hits']} hits, {cache_stats['misses']} misses"
+        )
+
+        router_stats = router.get_router().stats()
+        st.caption(
+            f"Request queue: {router_stats['queue_depth']} waiting, "
+            f"{router_stats['retries']} retries, {router_stats['throttled']} throttled"
+            + (f", paused {router_stats['paused_for']:.0f}s" if router_stats['paused_for'] else "")
+        )
+        if len(router_stats['backends']) > 1:
+            st.caption(f"Deployments ({router_stats['failovers']} failovers): " + ", ".join(
+                f"{backend['name']} {backend['state']}, {backend['in_flight']} in flight, "
+                f"{backend['latency_seconds']:.1f}s"
+                for backend in router_stats['backends']
+            ))
+
+        job_stats = jobs.get_queue().stats()
+        st.caption(f"Background jobs: {job_stats['queued']} queued, {job_stats['running']} running")
+
+        with st.expander("Request Metrics"):
+            metrics_panel()
+
         if st.button("Change System Prompt"):
             change_global_var(st.text_area(
                 "System Prompt",
@@ -458,6 +326,20 @@ def main():
 
     col1, col2 = st.columns([1,1])
 
+    # Create the output placeholders first so streamed responses can render into them
+    with col2:
+        st.subheader("Output")
+        job_area = st.container()
+        feedback_area = st.empty()
+        code_area = st.empty()
+        batch_area = st.container()
+
+    def render_output(feedback: str, refined_code: str):
+        if feedback:
+            feedback_area.markdown(feedback)
+        if refined_code:
+            code_area.code(refined_code, language='python')
+
     with col1:
         task_description = st.text_area(
             "Task Description",
@@ -466,82 +348,108 @@ def main():
         )
         is_editable = selected_action != "Submit Prompt"  # Disable editing if "Submit Prompt" is selected
 
+        continuing = st.session_state.conversation_mode and st.session_state.conversation.latest_code()
         code = st.text_area(
             "Your Code",
             height=300,
-            placeholder="Paste your code here...",
+            placeholder="Leave empty to continue with the conversation's latest code..." if continuing
+            else "Paste your code here...",
             help="Paste the code you want Azure OpenAI to analyze and improve",
             disabled=not is_editable
         )
 
 
-        if st.button("Submit", type="primary"):
+        # One job per session: a second one would replace the first before its output is shown
+        if st.button("Submit", type="primary", disabled=bool(st.session_state.job_id)):
             print("Selected Action:  ", selected_action)
+            if not code and is_editable and continuing:
+                code = st.session_state.conversation.latest_code()
             if selected_action == "Analyze Code":
                 #if not task_description:
                 if task_description is None or task_description.strip() == "":
                     print("No task description provided, defaulting to 'Analyze Code'")
-                    task_description = "Analyze Code"
+                    task_description = engine.ACTIONS["Analyze Code"]["default_task"]
                     #st.error("Please provide a task description")
                 if not code:
                     st.error("Please provide some code to analyze")
                 else:
-                    with st.spinner("Analyzing your code..."):
-                        print("Analyzing code with task description: ", task_description)
-                        feedback, refined_code = analyze_code(task_description, code)
-                        st.session_state.feedback = feedback
-                        st.session_state.refined_code = refined_code
-                        st.session_state.run_clicked = False
-
-            elif selected_action == "Create Readme":
+                    print("Analyzing code with task description: ", task_description)
+                    analyze_code(task_description, code, stream_output)
+                    st.session_state.run_clicked = False
+
+            elif selected_action == "Create README":
                 if task_description is None or task_description.strip() == "":
                     print("No task description provided, defaulting to 'Create Readme'")
-                    task_description = "Create Readme file for this code"
+                    task_description = engine.ACTIONS["Create README"]["default_task"]
                     #st.error("Task description will not be used in this prompt")
                 if not code:
                     st.error("Please provide code to generate readme file")
                 else:
-                    with st.spinner("Submitting your prompt..."):
-                        feedback, refined_code = create_readme(code)
-                        st.session_state.feedback = feedback
-                        st.session_state.refined_code = refined_code
-                        st.session_state.run_clicked = False
+                    create_readme(code, stream_output)
+                    st.session_state.run_clicked = False
 
             elif selected_action == "Explain Code":
                 if task_description is None or task_description.strip() == "":
                     print("No task description provided, defaulting to 'Explain Code'")
-                    task_description = "Explain this code, what the code does and what each line does"
+                    task_description = engine.ACTIONS["Explain Code"]["default_task"]
                     #st.error("Please provide a task description")
                 if not code:
                     st.error("Please provide some code to explain")
                 else:
-                    with st.spinner("Reading Code to provide explanation..."):
-                        feedback, refined_code = explain_code(task_description, code)
-                        st.session_state.feedback = feedback
-                        st.session_state.refined_code = refined_code
-                        st.session_state.run_clicked = False
+                    explain_code(task_description, code, stream_output)
+                    st.session_state.run_clicked = False
 
             elif selected_action == "Submit Prompt":
                 if task_description is None or task_description.strip() == "":
                     print("No task description provided, defaulting to 'Submit Prompt'")
-                    task_description = "You are a coding assistant. Provide expert coding help."
+                    task_description = engine.ACTIONS["Submit Prompt"]["default_task"]
                 if code:
                     st.error("The Code will not be used in this prompt.")
                 else:
-                    with st.spinner("Submitting your prompt..."):
-                        feedback, refined_code = submit_prompt(task_description)
-                        st.session_state.feedback = feedback
-                        st.session_state.refined_code = refined_code
-                        st.session_state.run_clicked = False
-
-    with col2:
-        st.subheader("Output")
-
-        if 'feedback' in st.session_state and st.session_state.feedback:
-            st.markdown(st.session_state.feedback)
-
-        if 'refined_code' in st.session_state and st.session_state.refined_code:
-            st.code(st.session_state.refined_code, language='python')
+                    submit_prompt(task_description, stream_output)
+                    st.session_state.run_clicked = False
+
+            if st.session_state.job_id:
+                # Rerun so Submit is disabled while the job runs
+                st.rerun()
+
+        with st.expander("Batch mode"):
+            batch_files = st.file_uploader(
+                "Source files or .zip archives",
+                accept_multiple_files=True,
+                help="Run the selected action on every file concurrently"
+            )
+            batch_clicked = st.button("Run Batch", disabled=selected_action == "Submit Prompt")
+            if batch_clicked:
+                files = read_batch_files(batch_files)
+                if not files:
+                    st.error("Please upload some files to run the batch")
+                else:
+                    print(f"Running {selected_action} on {len(files)} files")
+                    task = task_description.strip() or engine.ACTIONS[selected_action]["default_task"]
+                    asyncio.run(run_batch(selected_action, task, files, batch_area))
+
+    if not batch_clicked:
+        for name, (feedback, refined_code, error) in st.session_state.get('batch_results', {}).items():
+            render_batch_result(batch_area, name, feedback, refined_code, error)
+
+    feedback_area.empty()
+    code_area.empty()
+    if st.session_state.job_id:
+        with job_area:
+            job_output()
+    else:
+        if st.session_state.get('job_error'):
+            job_area.error(f"Error calling Azure OpenAI API: {st.session_state.job_error}")
+        render_output(st.session_state.get('feedback', ""), st.session_state.get('refined_code', ""))
+
+    session = st.session_state.conversation
+    if st.session_state.conversation_mode and len(session):
+        with col2.expander(f"Conversation ({len(session)} turns)"):
+            if session.summary:
+                st.markdown(f"**Summary of earlier turns**\n\n{session.summary}")
+            for turn in session.turns:
+                st.markdown(f"**{turn['action']}**: {turn['task_description']}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
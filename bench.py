@@ -0,0 +1,291 @@
+"""Offline benchmark of the app's request handling against the mock Azure server.
+
+Starts mock_aoai on a free port, points the app's modules at it, and runs N
+simulated users in parallel threads, the way Streamlit runs one script thread per
+session. Every iteration a user uploads their file, indexes it, and runs Analyze
+Code, Explain Code, Create README and Submit Prompt through the engine. Reports
+throughput, latency percentiles per operation and traced memory per session:
+
+    python bench.py --users 8 --iterations 3 --stream --latency 0.2 --token-rate 300
+
+With --backends N the completions are spread over N mock deployments through the
+router, and --error-rate makes the first of them fail like an unhealthy region:
+
+    python bench.py --users 8 --backends 3 --error-rate 0.5
+
+With --same-code every user works on the same file, like a team looking at a shared
+snippet, so identical requests in flight are coalesced into one completion.
+
+With --startup N it measures the import part of the cold start instead: the app is
+imported N times in fresh interpreters with -X importtime, and the slowest packages
+are reported:
+
+    python bench.py --startup 5 --max-startup 1.5
+
+No network access is needed, so it can run in CI; --max-p95, --max-errors and
+--max-startup make the run fail when latency, errors or startup time regress, and
+--json writes the results. The mock server shares the process with the simulated
+users, so the numbers are for comparing runs, not predictions of production latency.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+import metrics
+import mock_aoai
+
+ACTIONS = ("Analyze Code", "Explain Code", "Create README", "Submit Prompt")
+# Imports the app and every module it imports at startup. main() only runs under
+# `streamlit run`, so the first render is not part of the measurement.
+STARTUP_COMMAND = "import app"
+# Packages listed in the startup report
+STARTUP_TOP_PACKAGES = 10
+
+
+def sample_code(user: int, iteration: int, functions: int) -> str:
+    """Return a distinct source file for each user and iteration."""
+    body = []
+    for n in range(functions):
+        body.append(
+            f"def user{user}_function{n}(values):\n"
+            f"    \"\"\"Return the values scaled by {n + 1} (iteration {iteration}).\"\"\"\n"
+            f"    result = []\n"
+            f"    for value in values:\n"
+            f"        result.append(value * {n + 1})\n"
+            f"    return result\n"
+        )
+    return "\n\n".join(body)
+
+
+def configure(port: int, args, backend_ports=()):
+    """Point the app's configuration at the mock servers. Must run before the app modules are imported."""
+    if backend_ports:
+        os.environ["AZURE_OPENAI_BACKENDS"] = json.dumps([
+            {"name": f"mock{number}", "endpoint": f"http://127.0.0.1:{backend_port}",
+             "requests_per_minute": args.rpm, "tokens_per_minute": args.tpm}
+            for number, backend_port in enumerate(backend_ports, 1)
+        ])
+    os.environ.update({
+        "AZURE_OPENAI_ENDPOINT": f"http://127.0.0.1:{port}",
+        "AZURE_OPENAI_KEY": "mock",
+        "AZURE_OPENAI_API_VERSION": "2024-05-01-preview",
+        "AZURE_OPENAI_CHATGPT_DEPLOYMENT": "mock",
+        "AZURE_STORAGE_CONNECTION_STRING": mock_aoai.connection_string(port),
+        "CONTAINER_NAME": "bench",
+        "AZURE_AI_SEARCH_ENDPOINT": f"http://127.0.0.1:{port}",
+        "AZURE_AI_SEARCH_KEY": "mock",
+        "AZURE_AI_SEARCH_INDEX": "bench",
+        "AZURE_OPENAI_REQUESTS_PER_MINUTE": str(args.rpm),
+        "AZURE_OPENAI_TOKENS_PER_MINUTE": str(args.tpm),
+        "RESPONSE_CACHE_BACKEND": "memory" if args.cache else "none",
+        "AZURE_OPENAI_STREAM_USAGE": "true",
+    })
+
+
+def run_user(user: int, args, timings, errors):
+    """Run one simulated session."""
+    import engine
+    import indexing
+    import storage
+
+    on_update = (lambda feedback, code: None) if args.stream else None
+
+    def timed(operation: str, call):
+        start = time.perf_counter()
+        try:
+            call()
+        except Exception as e:
+            errors[operation].append(f"user {user}: {e}")
+            return
+        timings[operation].append(time.perf_counter() - start)
+
+    for iteration in range(args.iterations):
+        code = sample_code(0 if args.same_code else user, iteration, args.functions)
+        name = f"user{user}.py"
+        data = memoryview(code.encode("utf-8"))
+        timed("Upload", lambda: storage.upload_file(name, data))
+        timed("Index", lambda: indexing.index_files({name: data}))
+        for action in ACTIONS:
+            timed(action, lambda: engine.run_chunked(
+                action, "You are a helpful coding assistant.", f"Benchmark task {iteration}", code, on_update
+            ))
+
+
+def parse_importtime(stderr: str) -> Dict[str, float]:
+    """Return {top-level package: seconds} of import time from `python -X importtime` output."""
+    packages = defaultdict(float)
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        # Skips the header line
+        if self_us.strip().isdigit():
+            packages[name.strip().split(".")[0]] += int(self_us) / 1e6
+    return packages
+
+
+def run_startup(args) -> int:
+    """Import the app in fresh interpreters and report the cold start time and the slowest packages."""
+    runs, packages = [], defaultdict(list)
+    for _ in range(args.startup):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", STARTUP_COMMAND],
+                                 cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        runs.append(time.perf_counter() - start)
+        if process.returncode:
+            print(process.stderr[-2000:])
+            return 1
+        for package, seconds in parse_importtime(process.stderr).items():
+            packages[package].append(seconds)
+
+    median = metrics.percentile(runs, 0.5)
+    top = sorted(((metrics.percentile(values, 0.5), package) for package, values in packages.items()), reverse=True)
+    results = {
+        "startup_runs": [round(seconds, 3) for seconds in runs],
+        "startup_median_seconds": round(median, 3),
+        "import_seconds": {package: round(seconds, 3) for seconds, package in top[:STARTUP_TOP_PACKAGES]},
+    }
+    print(f"Cold start over {len(runs)} runs: median {median:.3f}s, "
+          f"runs {', '.join(f'{seconds:.3f}' for seconds in runs)}s")
+    print(f"{'package':<28}{'import s':>9}")
+    for package, seconds in results["import_seconds"].items():
+        print(f"{package:<28}{seconds:>9.3f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.max_startup and median > args.max_startup:
+        print(f"Cold start over {args.max_startup}s")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=4, help="concurrent simulated sessions")
+    parser.add_argument("--iterations", type=int, default=2, help="rounds of operations per user")
+    parser.add_argument("--functions", type=int, default=10, help="functions in each user's source file")
+    parser.add_argument("--stream", action="store_true", help="stream completions like the UI does")
+    parser.add_argument("--cache", action="store_true", help="enable the in-memory response cache")
+    parser.add_argument("--same-code", action="store_true", help="give every user the same source file")
+    parser.add_argument("--latency", type=float, default=0.1, help="mock seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=1000, help="mock completion tokens per second")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of mock requests answered with 429")
+    parser.add_argument("--backends", type=int, default=1, help="mock deployments to route completions across")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of requests the first deployment answers with 500")
+    parser.add_argument("--rpm", type=int, default=0, help="client-side requests per minute (0 = unlimited)")
+    parser.add_argument("--tpm", type=int, default=0, help="client-side tokens per minute (0 = unlimited)")
+    parser.add_argument("--max-p95", type=float, default=0.0, help="fail when any operation's p95 exceeds this many seconds")
+    parser.add_argument("--max-errors", type=int, default=0, help="fail when more operations than this fail")
+    parser.add_argument("--startup", type=int, default=0, metavar="RUNS",
+                        help="measure the cold start over RUNS fresh interpreters instead")
+    parser.add_argument("--max-startup", type=float, default=0.0, help="fail when the median cold start exceeds this many seconds")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+    if args.startup:
+        sys.exit(run_startup(args))
+
+    servers = [
+        mock_aoai.serve(0, latency=args.latency, token_rate=args.token_rate, throttle_rate=args.throttle_rate,
+                        error_rate=args.error_rate if number == 0 else 0.0)
+        for number in range(max(1, args.backends))
+    ]
+    server = servers[0]
+    configure(server.server_address[1], args,
+              [s.server_address[1] for s in servers] if len(servers) > 1 else ())
+
+    import clients
+    import engine
+    import router
+    clients.container_client().create_container()
+
+    timings = defaultdict(list)
+    errors = defaultdict(list)
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        for future in [pool.submit(run_user, user, args, timings, errors) for user in range(args.users)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    operations = sum(len(values) for values in timings.values())
+    failed = sum(len(values) for values in errors.values())
+    router_stats = router.get_router().stats()
+    states = [s.RequestHandlerClass.state for s in servers]
+    results = {
+        "users": args.users,
+        "iterations": args.iterations,
+        "stream": args.stream,
+        "elapsed_seconds": round(elapsed, 3),
+        "operations_per_second": round(operations / elapsed, 2),
+        "completions": sum(state.requests for state in states),
+        "completions_per_second": round(sum(state.requests for state in states) / elapsed, 2),
+        "coalesced": sum(bool(sample.get("coalesced")) for action in engine.ACTIONS
+                         for sample in metrics.recorder.samples(action)),
+        "throttled": sum(state.throttled for state in states),
+        "server_errors": sum(state.errors for state in states),
+        "retries": router_stats["retries"],
+        "failovers": router_stats["failovers"],
+        "backends": {row["name"]: {"requests": row["requests"], "errors": row["errors"], "state": row["state"]}
+                     for row in router_stats["backends"]},
+        "errors": failed,
+        "peak_memory_mb": round((peak - baseline) / 2 ** 20, 2),
+        "memory_per_session_mb": round((peak - baseline) / 2 ** 20 / args.users, 2),
+        "operations": {
+            operation: {
+                "count": len(values),
+                "errors": len(errors[operation]),
+                "p50": round(metrics.percentile(values, 0.5), 3),
+                "p95": round(metrics.percentile(values, 0.95), 3),
+                "p99": round(metrics.percentile(values, 0.99), 3),
+            }
+            for operation, values in timings.items()
+        },
+        "cached_prompt_percent": {row["action"]: row["cached prompt %"] for row in metrics.recorder.summary()},
+    }
+    for s in servers:
+        s.shutdown()
+
+    print(f"{args.users} users x {args.iterations} iterations in {elapsed:.1f}s: "
+          f"{results['operations_per_second']} operations/s, {results['completions_per_second']} completions/s, "
+          f"{results['throttled']} throttled, {results['retries']} retries, {results['coalesced']} coalesced, "
+          f"{failed} errors")
+    if len(servers) > 1:
+        print(f"{results['failovers']} failovers; " + ", ".join(
+            f"{name} {row['requests']} requests, {row['errors']} errors, {row['state']}"
+            for name, row in results["backends"].items()))
+    print(f"Traced memory: {results['peak_memory_mb']} MiB peak, {results['memory_per_session_mb']} MiB per session")
+    print(f"{'operation':<16}{'count':>7}{'errors':>8}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}")
+    for operation, row in results["operations"].items():
+        print(f"{operation:<16}{row['count']:>7}{row['errors']:>8}{row['p50']:>9.3f}{row['p95']:>9.3f}{row['p99']:>9.3f}")
+    print("Prompt tokens served from the prompt cache: " + ", ".join(
+        f"{action} {percent}%" for action, percent in results["cached_prompt_percent"].items()))
+    for operation, messages in errors.items():
+        for message in messages[:3]:
+            print(f"{operation} failed for {message}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    slow = [operation for operation, row in results["operations"].items()
+            if args.max_p95 and row["p95"] > args.max_p95]
+    if slow:
+        print(f"p95 over {args.max_p95}s for: {', '.join(slow)}")
+    if slow or failed > args.max_errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
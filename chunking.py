@@ -0,0 +1,134 @@
+"""Token counting and AST-based chunking of source files.
+
+Large modules do not fit in one request: the prompt grows past the context window
+and the refined code no longer fits in the output budget. split_code cuts a file
+along its top-level functions and classes into chunks under a token budget so
+each chunk can be analyzed on its own. Where a chunk ends is decided by the content
+of its last definition, not by the sizes of the code before it, so editing one
+function leaves the other chunks, and their cached responses, unchanged.
+"""
+import ast
+import hashlib
+import os
+import re
+import threading
+from functools import lru_cache
+from typing import List
+
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")
+# Largest chunk of code sent in one request
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "3000"))
+
+
+@lru_cache(maxsize=None)
+def _encoding():
+    # Imported on first use: tiktoken is optional and takes a while to import
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        # tiktoken downloads its vocabulary on first use, which fails offline
+        print(f"Tokenizer {TOKENIZER_ENCODING} unavailable, estimating tokens instead: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Count tokens with tiktoken when it is installed, otherwise estimate ~4 characters per token."""
+    if not text:
+        return 0
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _split_lines(lines: List[str], max_tokens: int) -> List[str]:
+    """Split lines into chunks under max_tokens, for code that has no usable structure."""
+    chunks, current, size = [], [], 0
+    for line in lines:
+        line_tokens = count_tokens(line)
+        if current and size + line_tokens > max_tokens:
+            chunks.append("".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += line_tokens
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+
+# Concurrent ast.parse calls can fail with SystemError on some CPython 3.11 releases
+_parse_lock = threading.Lock()
+
+
+def _segments(code: str) -> List[str]:
+    """Cut code into top-level statements, keeping comments with the statement that follows.
+
+    Each segment starts right after the previous statement ends, so the blank lines
+    and comments between two definitions lead the second one.
+    """
+    # Split on the same line endings ast counts, so node line numbers index into lines
+    lines = re.findall(r".*?(?:\r\n|\n|\r)|.+$", code, re.DOTALL)
+    try:
+        with _parse_lock:
+            body = ast.parse(code).body
+    except SyntaxError:
+        return lines
+
+    if not body:
+        return ["".join(lines)]
+    starts = [0]
+    for previous, node in zip(body, body[1:]):
+        start = node.lineno
+        for decorator in getattr(node, "decorator_list", []):
+            start = min(start, decorator.lineno)
+        # Statements sharing a line with the previous one stay in its segment
+        starts.append(max(starts[-1], min(start - 1, previous.end_lineno)))
+    ends = starts[1:] + [len(lines)]
+    return ["".join(lines[start:end]) for start, end in zip(starts, ends) if end > start]
+
+
+def _ends_chunk(segment: str, segment_tokens: int, target_tokens: int) -> bool:
+    """Return whether a chunk ends after this segment, decided by the segment alone.
+
+    A hash of the segment's text ends the chunk with probability segment_tokens /
+    target_tokens, so chunks average about target_tokens without the decision
+    depending on any other part of the file.
+    """
+    digest = hashlib.sha256(segment.strip().encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64 < segment_tokens / target_tokens
+
+
+def split_code(code: str, max_tokens: int = CHUNK_MAX_TOKENS) -> List[str]:
+    """Split code into chunks of whole top-level functions and classes under max_tokens.
+
+    Neighbouring definitions are grouped until one whose content marks the end of a
+    chunk (see _ends_chunk), aiming at half the budget; a group that would pass the
+    budget is cut early, which only moves boundaries inside that group. Joining the
+    chunks gives back the original code. A single definition larger than the budget,
+    or code that does not parse, is split by lines.
+    """
+    target_tokens = max(1, max_tokens // 2)
+    chunks, current, size = [], [], 0
+    for segment in _segments(code):
+        segment_tokens = count_tokens(segment)
+        if segment_tokens > max_tokens:
+            if current:
+                chunks.append("".join(current))
+                current, size = [], 0
+            chunks.extend(_split_lines(segment.splitlines(keepends=True), max_tokens))
+            continue
+        if current and size + segment_tokens > max_tokens:
+            chunks.append("".join(current))
+            current, size = [], 0
+        current.append(segment)
+        size += segment_tokens
+        if _ends_chunk(segment, segment_tokens, target_tokens):
+            chunks.append("".join(current))
+            current, size = [], 0
+    if current:
+        chunks.append("".join(current))
+    return chunks
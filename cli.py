@@ -0,0 +1,140 @@
+"""Command line entry point for scripts, CI jobs and pre-commit hooks.
+
+    python -m cli analyze app.py --task "Find bugs"
+    python -m cli explain engine.py --stream
+    python -m cli readme app.py --code-only > README.generated.md
+    python -m cli prompt "Write a function that parses ISO dates"
+    python -m cli analyze src/*.py --json
+    python -m cli serve --port 8080
+
+The actions use the same engine, response cache, rate limiter and .env settings as
+the Streamlit app. Several files are processed concurrently like the app's batch
+mode, and "-" reads code from stdin. Results go to stdout and the engine's log to
+stderr; the exit status is 1 when any request fails. serve starts the HTTP API in
+api.py.
+"""
+import argparse
+import asyncio
+import json
+import sys
+from contextlib import redirect_stdout
+from typing import Dict, List, TextIO
+
+import engine
+
+
+def read_files(paths: List[str]) -> Dict[str, str]:
+    """Return {path: source text} for the paths, reading "-" from stdin."""
+    files = {}
+    for path in paths:
+        if path == "-":
+            files["<stdin>"] = sys.stdin.read()
+        else:
+            with open(path, encoding="utf-8") as f:
+                files[path] = f.read()
+    return files
+
+
+def write_result(out: TextIO, args, name: str, feedback: str, refined_code: str, error: str = "",
+                 header: bool = False):
+    if args.json:
+        out.write(json.dumps({"file": name, "feedback": feedback, "code": refined_code, "error": error}) + "\n")
+        return
+    if header:
+        out.write(f"==> {name} <==\n")
+    if error:
+        print(f"{name}: Error calling Azure OpenAI API: {error}", file=sys.stderr)
+    if feedback and not args.code_only:
+        out.write(feedback + "\n\n")
+    if refined_code:
+        out.write(refined_code + "\n")
+    out.flush()
+
+
+def run_one(out: TextIO, args, action: str, task_description: str, name: str, code: str) -> int:
+    """Run an action on one input, printing the feedback as it streams when asked to."""
+    printed = ""
+
+    def print_feedback(feedback: str, refined_code: str):
+        nonlocal printed
+        if feedback.startswith(printed) and feedback != printed:
+            out.write(feedback[len(printed):])
+            out.flush()
+            printed = feedback
+
+    on_update = print_feedback if args.stream and not args.json and not args.code_only else None
+    try:
+        feedback, refined_code = engine.run_chunked(action, args.system, task_description, code, on_update)
+    except Exception as e:
+        write_result(out, args, name, "", "", str(e))
+        return 1
+    if printed and feedback.startswith(printed):
+        # Only the end of the feedback is not on screen yet
+        out.write(feedback[len(printed):] + "\n\n")
+        feedback = ""
+    elif printed:
+        # The complete response parsed differently from the stream, so print it again in full
+        out.write("\n\n==> Final response <==\n")
+    write_result(out, args, name, feedback, refined_code)
+    return 0
+
+
+async def run_many(out: TextIO, args, action: str, task_description: str, files: Dict[str, str]) -> int:
+    """Run an action over many files concurrently, printing each result as it completes."""
+    failed = 0
+    async for name, feedback, refined_code, error in engine.run_batch(action, args.system, task_description, files):
+        write_result(out, args, name, feedback, refined_code, error, header=True)
+        failed += bool(error)
+    return 1 if failed else 0
+
+
+def run(out: TextIO, args) -> int:
+    if args.command == "serve":
+        import api
+        asyncio.run(api.serve(args.port or api.API_PORT))
+        return 0
+
+    action = engine.COMMANDS[args.command]
+    if action == "Submit Prompt":
+        task_description = sys.stdin.read() if args.task == "-" else args.task
+        return run_one(out, args, action, task_description.strip() or engine.ACTIONS[action]["default_task"],
+                       "<prompt>", "")
+
+    task_description = (args.task or "").strip() or engine.ACTIONS[action]["default_task"]
+    try:
+        files = read_files(args.files)
+    except OSError as e:
+        print(f"Cannot read {e.filename}: {e.strerror}", file=sys.stderr)
+        return 2
+    if len(files) == 1:
+        name, code = next(iter(files.items()))
+        return run_one(out, args, action, task_description, name, code)
+    return asyncio.run(run_many(out, args, action, task_description, files))
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    for command, action in engine.COMMANDS.items():
+        sub = commands.add_parser(command, help=action)
+        if action == "Submit Prompt":
+            sub.add_argument("task", help='the prompt, or "-" to read it from stdin')
+        else:
+            sub.add_argument("files", nargs="+", help='source files, or "-" for stdin')
+            sub.add_argument("--task", help="task description")
+        sub.add_argument("--system", default=engine.DEFAULT_SYS_PROMPT, help="system prompt")
+        sub.add_argument("--stream", action="store_true", help="print the feedback while it is generated")
+        sub.add_argument("--json", action="store_true", help="print one JSON object per input")
+        sub.add_argument("--code-only", action="store_true", help="print only the code section")
+    serve = commands.add_parser("serve", help="run the HTTP API")
+    serve.add_argument("--port", type=int, help="port to listen on (default API_PORT)")
+    args = parser.parse_args(argv)
+
+    # The engine logs with print, so keep stdout for the results
+    out = sys.stdout
+    with redirect_stdout(sys.stderr):
+        return run(out, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+"""Configuration and Azure clients shared by every Streamlit session.
+
+Streamlit re-executes app.py on every widget interaction, so clients built at its
+top level were rebuilt on every rerun. Here each client is created on first use
+and then reused by the whole process, like st.cache_resource but also usable
+outside Streamlit. Clients a worker never needs, such as the blob and indexer
+clients when nobody uploads or re-indexes, are never built. All clients share
+pooled keep-alive HTTP connections.
+
+The SDKs are imported by the functions that build their clients, not at the top of
+the module: together they take about a second to import, which a cold start would
+otherwise spend before the first page render. Each SDK loads when its first client
+is built.
+"""
+import os
+import threading
+from functools import lru_cache, wraps
+from typing import TYPE_CHECKING
+
+from dotenv import load_dotenv
+
+if TYPE_CHECKING:
+    import httpx
+    from openai import AsyncAzureOpenAI, AzureOpenAI
+    from azure.core.pipeline.transport import RequestsTransport
+    from azure.identity import DefaultAzureCredential
+    from azure.storage.blob import BlobServiceClient, ContainerClient
+    from azure.search.documents import SearchClient
+    from azure.search.documents.indexes import SearchIndexerClient
+
+load_dotenv()
+# Azure OpenAI configuration
+endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+model = os.getenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT")
+api_key = os.getenv("AZURE_OPENAI_KEY")
+api_version = os.getenv("AZURE_OPENAI_API_VERSION")
+
+# Azure Storage configuration
+STORAGE_ACCOUNT_NAME = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
+CONTAINER_NAME = os.getenv("CONTAINER_NAME")
+ACCOUNT_URL: str = f"https://{STORAGE_ACCOUNT_NAME}.blob.core.windows.net"
+# Overrides the account and its credential, e.g. for the Azurite emulator or the mock server
+STORAGE_CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+
+# Azure Search configuration
+search_endpoint = os.getenv("AZURE_AI_SEARCH_ENDPOINT")
+search_key = os.getenv("AZURE_AI_SEARCH_KEY")
+search_index = os.getenv("AZURE_AI_SEARCH_INDEX")
+search_indexer = os.getenv("AZURE_AI_SEARCH_INDEXER")
+
+# Blobs up to UPLOAD_SINGLE_PUT_BYTES are sent in one request, larger ones in parallel blocks
+UPLOAD_SINGLE_PUT_BYTES = int(os.getenv("UPLOAD_SINGLE_PUT_BYTES", str(8 * 1024 * 1024)))
+UPLOAD_BLOCK_BYTES = int(os.getenv("UPLOAD_BLOCK_BYTES", str(4 * 1024 * 1024)))
+
+# Size of the HTTP connection pools
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "60"))
+
+
+_clients_lock = threading.RLock()
+
+
+def shared(factory):
+    """Cache a client factory like lru_cache, building the client once even when sessions ask for it concurrently."""
+    cached = lru_cache(maxsize=None)(factory)
+
+    @wraps(factory)
+    def get():
+        with _clients_lock:
+            return cached()
+    return get
+
+
+def _limits() -> "httpx.Limits":
+    import httpx
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_SECONDS,
+    )
+
+
+def make_openai_client(azure_endpoint: str, key: str, version: str) -> "AzureOpenAI":
+    """Return a new Azure OpenAI client for an endpoint with a pooled HTTP client."""
+    from openai import AzureOpenAI, DefaultHttpxClient
+    # Retries are handled by the rate limiter so throttled calls wait in its queue
+    return AzureOpenAI(
+        azure_endpoint = azure_endpoint,
+        api_key = key,
+        api_version = version,
+        max_retries = 0,
+        http_client = DefaultHttpxClient(limits=_limits())
+    )
+
+
+def make_async_openai_client(azure_endpoint: str, key: str, version: str) -> "AsyncAzureOpenAI":
+    """Return a new async Azure OpenAI client for an endpoint."""
+    from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
+    return AsyncAzureOpenAI(
+        azure_endpoint = azure_endpoint,
+        api_key = key,
+        api_version = version,
+        max_retries = 0,
+        http_client = DefaultAsyncHttpxClient(limits=_limits())
+    )
+
+
+@shared
+def openai_client() -> "AzureOpenAI":
+    """Return the process-wide Azure OpenAI client."""
+    print("Azure OpenAI API initialized")
+    return make_openai_client(endpoint, api_key, api_version)
+
+
+@shared
+def azure_transport() -> "RequestsTransport":
+    """Return the HTTP transport shared by the Azure SDK clients."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from azure.core.pipeline.transport import RequestsTransport
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_MAX_CONNECTIONS,
+                          pool_maxsize=HTTP_MAX_CONNECTIONS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return RequestsTransport(session=session, session_owner=False)
+
+
+@shared
+def credential() -> "DefaultAzureCredential":
+    """Return the process-wide Azure credential, which caches its access tokens."""
+    from azure.identity import DefaultAzureCredential
+    return DefaultAzureCredential()
+
+
+@shared
+def blob_service_client() -> "BlobServiceClient":
+    from azure.storage.blob import BlobServiceClient
+    if STORAGE_CONNECTION_STRING:
+        return BlobServiceClient.from_connection_string(
+            STORAGE_CONNECTION_STRING, transport=azure_transport(),
+            max_single_put_size=UPLOAD_SINGLE_PUT_BYTES, max_block_size=UPLOAD_BLOCK_BYTES)
+    return BlobServiceClient(account_url=ACCOUNT_URL, credential=credential(), transport=azure_transport(),
+                             max_single_put_size=UPLOAD_SINGLE_PUT_BYTES, max_block_size=UPLOAD_BLOCK_BYTES)
+
+
+@shared
+def container_client() -> "ContainerClient":
+    return blob_service_client().get_container_client(CONTAINER_NAME)
+
+
+@shared
+def search_client() -> "SearchClient":
+    from azure.core.credentials import AzureKeyCredential
+    from azure.search.documents import SearchClient
+    return SearchClient(endpoint=search_endpoint, index_name=search_index,
+                        credential=AzureKeyCredential(search_key), transport=azure_transport())
+
+
+@shared
+def indexer_client() -> "SearchIndexerClient":
+    from azure.core.credentials import AzureKeyCredential
+    from azure.search.documents.indexes import SearchIndexerClient
+    return SearchIndexerClient(endpoint=search_endpoint, credential=AzureKeyCredential(search_key),
+                               transport=azure_transport())
@@ -0,0 +1,144 @@
+"""Multi-turn conversations with a bounded context.
+
+Without a conversation every request is a fresh system + user exchange, so a
+follow-up such as "now make it async" needs the code pasted again and pays for
+all of it again. A Conversation keeps the turns of one session and renders them
+as history messages for the next request:
+
+- the most recent turns are kept verbatim,
+- once the history exceeds HISTORY_TOKEN_BUDGET, older turns are folded into a
+  running summary written by the model,
+- code blocks are identified by a hash, sent once, and referred to by that hash
+  afterwards, including code the user sends again unchanged.
+"""
+import hashlib
+import os
+import threading
+from typing import List, Optional, Tuple
+
+import engine
+from chunking import count_tokens
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "4000"))
+# Turns always kept verbatim, however long they are
+RECENT_TURNS = int(os.getenv("HISTORY_RECENT_TURNS", "2"))
+# Longest excerpt of a turn's feedback kept when the summary cannot be generated
+FALLBACK_SUMMARY_CHARS = 300
+
+
+def code_hash(code: str) -> str:
+    """Return the short hash that identifies a code block in the conversation."""
+    return hashlib.sha256(code.strip().encode("utf-8")).hexdigest()[:8]
+
+
+def code_reference(code: str) -> str:
+    """Return what is sent instead of a code block the model has already seen."""
+    return f"# Same code as block {code_hash(code)} earlier in this conversation"
+
+
+class Conversation:
+    """Turns of one session plus a summary of the turns that no longer fit the budget.
+
+    Job workers prepare requests while the script thread records turns, so both hold
+    the conversation's lock.
+    """
+
+    def __init__(self, budget: int = HISTORY_TOKEN_BUDGET, recent_turns: int = RECENT_TURNS):
+        self.budget = budget
+        self.recent_turns = recent_turns
+        self.turns: List[dict] = []
+        self.summary = ""
+        self.summarized_turns = 0
+        # Reentrant because prepare() compacts while holding it
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self.summarized_turns + len(self.turns)
+
+    def add_turn(self, action: str, task_description: str, code: str, feedback: str, refined_code: str):
+        with self._lock:
+            self.turns.append({
+                "action": action,
+                "task_description": task_description,
+                "code": code,
+                "feedback": feedback,
+                "refined_code": refined_code,
+            })
+
+    def latest_code(self) -> str:
+        """Return the most recent code of the conversation, preferring the assistant's version."""
+        with self._lock:
+            for turn in reversed(self.turns):
+                if turn["refined_code"] or turn["code"]:
+                    return turn["refined_code"] or turn["code"]
+        return ""
+
+    def _render(self, turns: List[dict], seen: set) -> List[dict]:
+        """Render turns as chat messages, sending each code block once and adding its hash to `seen`."""
+        def block(code: str) -> str:
+            digest = code_hash(code)
+            if digest in seen:
+                return f"(code block {digest}, shown earlier)"
+            seen.add(digest)
+            return f"Code block {digest}:\n```python\n{code.strip()}\n```"
+
+        messages = []
+        for turn in turns:
+            request = f"{turn['action']}: {turn['task_description']}".strip()
+            if turn["code"]:
+                request += "\n\n" + block(turn["code"])
+            response = turn["feedback"]
+            if turn["refined_code"]:
+                response += "\n\n" + block(turn["refined_code"])
+            messages.append({"role": "user", "content": request})
+            messages.append({"role": "assistant", "content": response.strip()})
+        return messages
+
+    def _summary_messages(self) -> List[dict]:
+        if not self.summary:
+            return []
+        return [{"role": "system", "content": f"Summary of the earlier conversation:\n{self.summary}"}]
+
+    def _history_tokens(self) -> int:
+        return history_tokens(self._summary_messages() + self._render(self.turns, set()))
+
+    def compact(self, sys_prompt: str):
+        """Fold all but the recent turns into the summary when the history is over budget."""
+        with self._lock:
+            if len(self.turns) <= self.recent_turns or self._history_tokens() <= self.budget:
+                return
+            split = len(self.turns) - self.recent_turns
+            folded, self.turns = self.turns[:split], self.turns[split:]
+            transcript = "\n\n".join(f"{m['role'].title()}: {m['content']}" for m in self._render(folded, set()))
+            if self.summary:
+                transcript = f"Summary so far:\n{self.summary}\n\nLater turns:\n{transcript}"
+            try:
+                summary, _ = engine.run_action("Summarize Conversation", sys_prompt, "", transcript)
+            except Exception as e:
+                print(f"Could not summarize the conversation, keeping excerpts instead: {e}")
+                summary = ""
+            if not summary:
+                excerpts = [f"- {turn['action']}: {turn['task_description']} -> {turn['feedback'][:FALLBACK_SUMMARY_CHARS]}"
+                            for turn in folded]
+                summary = "\n".join(([self.summary] if self.summary else []) + excerpts)
+            self.summary = summary
+            self.summarized_turns += len(folded)
+
+    def prepare(self, sys_prompt: str, code: str) -> Tuple[List[dict], str]:
+        """Compact the history and return (history messages, code) for the next request.
+
+        The returned code is a reference to an earlier block when the model has already
+        seen the same code verbatim in the history.
+        """
+        with self._lock:
+            self.compact(sys_prompt)
+            seen = set()
+            history = self._summary_messages() + self._render(self.turns, seen)
+            if code and code_hash(code) in seen:
+                code = code_reference(code)
+            return history, code
+
+
+def history_tokens(history: Optional[List[dict]]) -> int:
+    """Return the token count of history messages."""
+    return sum(count_tokens(m["content"]) for m in history or [])
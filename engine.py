@@ -0,0 +1,607 @@
+"""Request engine shared by all actions.
+
+Every action sends the same kind of chat completion: the system prompt, the
+action's fixed instructions, a prompt built from the action's template, and an
+Azure AI Search data source. The templates and their per-action settings live in
+ACTIONS. Requests are looked up in the cache, built and sized, and parsed and cached
+by lookup, plan_request and finish; run_action and its async version arun_action only
+differ in how they send them. run_batch fans one action out over many files with the
+async client.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import metrics
+import response_cache
+import response_parser
+import retrieval
+import router
+import singleflight
+import token_budget
+from chunking import CHUNK_MAX_TOKENS, count_tokens, split_code
+from clients import model, search_endpoint, search_index, search_key
+
+# Parallel requests for batches and chunked files
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+# Ask for token usage, including cached prompt tokens, at the end of streamed responses.
+# Needs API version 2024-09-01-preview or later.
+STREAM_USAGE = os.getenv("AZURE_OPENAI_STREAM_USAGE", "false").lower() == "true"
+# Ask for JSON matching response_parser.RESPONSE_SCHEMA instead of the text markers.
+# Needs API version 2024-08-01-preview or later and a model that supports structured
+# outputs; requests that send the Azure AI Search data source keep the text format.
+STRUCTURED_OUTPUT = os.getenv("AZURE_OPENAI_STRUCTURED_OUTPUT", "false").lower() == "true"
+
+DEFAULT_SYS_PROMPT = (
+    "You are an assistant to a programmer, in responses only provide code when asked to convert.  "
+    "When asked to explain, provide detailed explanation that is technical in depth"
+)
+
+# Minimum delay between UI refreshes while a response is streaming
+STREAM_REFRESH_SECONDS = 0.05
+
+OUTPUT_FORMAT = """
+Format your response exactly as follows:
+---FEEDBACK---
+[Your feedback here]
+---CODE---
+[The {code_label} here without any markdown formatting or additional explanation within the code section]
+"""
+
+# Replaces the text format in the instructions of structured requests. Every action's
+# instructions end with the format, starting with FORMAT_HEADING.
+FORMAT_HEADING = "Format your response exactly as follows:"
+STRUCTURED_FORMAT = """
+Respond with a JSON object. Put your response text in "feedback", the code or document you were asked for in "code_blocks" with its language, and the names of the provided documents you used in "citations". Leave "code_blocks" empty when asked to leave the code section empty.
+"""
+
+# Prompt templates and request settings for each action. "instructions" is the fixed
+# text of the action and is sent right after the system prompt, so every request of
+# an action starts with the same bytes and can reuse the service's prompt cache.
+# "prompt" holds the variable part, filled with {task_description} and {code}, and
+# is sent last. "default_task" replaces an empty task description. max_tokens (the
+# ceiling under which token_budget adapts each request's limit), top_n_documents and
+# strictness tune the completion and retrieval (top_n_documents=0 skips retrieval).
+# Code over the chunk budget is split and the per-chunk results are combined by the
+# "reduce" action. Internal actions are not offered to users.
+ACTIONS = {
+    "Submit Prompt": {
+        "instructions": """
+Please provide:
+1. A detailed technical response
+2. Expert written code if asked to generate code
+
+""" + OUTPUT_FORMAT.format(code_label="generated code"),
+        "prompt": """
+Task Description: {task_description}
+""",
+        "default_task": "You are a coding assistant. Provide expert coding help.",
+        "max_tokens": 8000,
+        "top_n_documents": 5,
+        "strictness": 3,
+    },
+    "Analyze Code": {
+        "instructions": """
+Please provide:
+1. A detailed code review and feedback
+2. A refined version of the code that implements the requested changes
+3. Make sure the code doesn't require user input and uses test cases instead
+4. Prefer using emoji-based output over terminal colors for better compatibility
+5. If using colors, use only standard print statements or emojis
+6. If asked, explain the code in detail
+""" + OUTPUT_FORMAT.format(code_label="refined code"),
+        "prompt": """
+
+Task Description: {task_description}
+
+
+Original Code:
+```python
+{code}
+```
+""",
+        "default_task": "Analyze Code",
+        "max_tokens": 8000,
+        "top_n_documents": 5,
+        "strictness": 3,
+        "reduce": "Merge Feedback",
+    },
+    "Explain Code": {
+        "instructions": """
+Please provide:
+1. A detailed code explanation
+2. Explain line by line the code and what it does
+3. Offer suggestions for improvement
+4. Provide examples of how the code can be used
+
+""" + OUTPUT_FORMAT.format(code_label="refined code"),
+        "prompt": """
+Task Description: {task_description}
+
+
+Original Code:
+```python
+{code}
+```
+""",
+        "default_task": "Explain this code, what the code does and what each line does",
+        "max_tokens": 8000,
+        "top_n_documents": 5,
+        "strictness": 3,
+        "reduce": "Merge Feedback",
+    },
+    "Create README": {
+        "instructions": """
+Please:
+1. Create a well formatted readme.md file that is comprehensive and easy to understand
+2. Describe purpose of code
+3. Details about prerequisites, installation, usage, and examples
+""" + OUTPUT_FORMAT.format(code_label="refined code"),
+        "prompt": """
+
+Original Code:
+```python
+{code}
+```
+""",
+        "default_task": "Create Readme file for this code",
+        "max_tokens": 4000,
+        "top_n_documents": 3,
+        "strictness": 3,
+        "reduce": "Merge README",
+    },
+    "Merge Feedback": {
+        "instructions": """
+The source file was too large to process at once, so it was split into parts and each part was reviewed separately.
+
+Please:
+1. Merge the feedback for all parts into one coherent response for the whole file
+2. Remove repetition while keeping every distinct finding and suggestion
+3. Leave the code section empty, the code of the parts is combined separately
+
+Format your response exactly as follows:
+---FEEDBACK---
+[Your merged feedback here]
+---CODE---
+""",
+        "prompt": """
+Task Description: {task_description}
+
+Responses for each part:
+
+{code}
+""",
+        "max_tokens": 4000,
+        "top_n_documents": 0,
+        "strictness": 3,
+        "internal": True,
+    },
+    "Merge README": {
+        "instructions": """
+The source file was too large to process at once, so it was split into parts and a readme.md was written for each part.
+
+Please:
+1. Combine the readme.md files into a single well formatted readme.md for the whole file
+2. Remove repetition while keeping every distinct detail
+3. Describe the purpose of the code, prerequisites, installation, usage, and examples
+""" + OUTPUT_FORMAT.format(code_label="combined readme.md"),
+        "prompt": """
+Responses for each part:
+
+{code}
+""",
+        "max_tokens": 4000,
+        "top_n_documents": 0,
+        "strictness": 3,
+        "internal": True,
+        "merges_code": True,
+    },
+    "Summarize Conversation": {
+        "instructions": """
+You will be given the beginning of a conversation between a programmer and you about their code.
+Code blocks are labeled with a hash so later turns can refer to them.
+
+Please:
+1. Summarize the conversation so it can continue without the full transcript
+2. Keep the requirements, decisions, open questions and the names of files, functions and classes
+3. Describe the current state of the code and keep the hash labels of the code blocks mentioned
+4. Be concise and leave the code section empty
+
+Format your response exactly as follows:
+---FEEDBACK---
+[Your summary here]
+---CODE---
+""",
+        "prompt": """
+{code}
+""",
+        "max_tokens": 1000,
+        "top_n_documents": 0,
+        "strictness": 3,
+        "internal": True,
+    },
+}
+
+# Actions offered to users
+ACTION_NAMES = [name for name, template in ACTIONS.items() if not template.get("internal")]
+
+# Short names of the user actions for the HTTP API and the command line
+COMMANDS = {
+    "prompt": "Submit Prompt",
+    "analyze": "Analyze Code",
+    "explain": "Explain Code",
+    "readme": "Create README",
+}
+
+# Added to the task description of each chunk. It does not mention the chunk's position
+# so an unchanged chunk keeps its cache key when other parts of the file change.
+CHUNK_NOTE = "\n\nThe code below is one part of a larger file. Only respond about this part."
+
+
+def search_data_source(top_n_documents: int, strictness: int) -> dict:
+    """Return the Azure AI Search data source block for a completion."""
+    return {
+        "type": "azure_search",
+        "parameters": {
+            "endpoint": search_endpoint,
+            "index_name": search_index,
+            "semantic_configuration": "default",
+            "query_type": "simple",
+            "fields_mapping": {},
+            "in_scope": True,
+            "filter": None,
+            "strictness": strictness,
+            "top_n_documents": top_n_documents,
+            "authentication": {
+                "type": "api_key",
+                "key": search_key
+            }
+        }
+    }
+
+
+def build_request(action: str, sys_prompt: str, task_description: str = "", code: str = "",
+                  history: Optional[List[dict]] = None) -> dict:
+    """Return the chat completion arguments for an action.
+
+    With local retrieval the relevant snippets are added to the messages instead of
+    sending the Azure AI Search data source, and nothing is added when none is relevant.
+    Conversation history messages go between the instructions and the prompt. With
+    STRUCTURED_OUTPUT the request carries a response_format, unless it sends the data
+    source, which does not support one.
+    """
+    template = ACTIONS[action]
+    prompt = template["prompt"].format(task_description=task_description, code=code)
+    use_search = bool(template["top_n_documents"]) and not retrieval.LOCAL_RETRIEVAL
+    structured = STRUCTURED_OUTPUT and not use_search
+    instructions = template["instructions"]
+    if structured:
+        instructions = instructions.split(FORMAT_HEADING)[0].rstrip() + "\n" + STRUCTURED_FORMAT
+    # Ordered from the most to the least stable part, so repeated requests share the
+    # longest possible prefix: the same action always starts with identical messages,
+    # and a conversation's history only grows at its end
+    messages = [
+        {
+            "role": "system",
+            "content": sys_prompt
+        },
+        {
+            "role": "system",
+            "content": instructions
+        }
+    ]
+    messages.extend(history or [])
+    if template["top_n_documents"] and retrieval.LOCAL_RETRIEVAL:
+        documents = retrieval.retrieve(f"{task_description}\n{code}", template["top_n_documents"])
+        if documents:
+            messages.append({"role": "system", "content": retrieval.format_context(documents)})
+    messages.append({
+        "role": "user",
+        "content": prompt
+    })
+    request = dict(
+        model=model,
+        messages=messages,
+        max_tokens=template["max_tokens"],
+        temperature=0,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0,
+        stop=None,
+        extra_body={
+            "data_sources": [
+                search_data_source(template["top_n_documents"], template["strictness"])
+            ]
+        } if use_search else None
+    )
+    if structured:
+        request["response_format"] = response_parser.RESPONSE_FORMAT
+    return request
+
+
+def record_usage(sample: dict, usage):
+    """Copy the token counts of a completion's usage block into a metrics sample."""
+    if usage is None:
+        return
+    sample["prompt_tokens"] = usage.prompt_tokens
+    sample["completion_tokens"] = usage.completion_tokens
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is not None and getattr(details, "cached_tokens", None) is not None:
+        sample["cached_tokens"] = details.cached_tokens
+
+
+def count_citations(context) -> int:
+    """Return the number of citations in the Azure "On Your Data" context of a message."""
+    if not isinstance(context, dict):
+        return 0
+    return len(context.get("citations") or [])
+
+
+def read_content(response, on_update: Optional[Callable[[str, str], None]] = None,
+                 sample: Optional[dict] = None, structured: bool = False) -> str:
+    """Return the completion text, passing partial feedback/code to on_update while it streams.
+
+    When a metrics sample dict is given, the time to first token, token usage,
+    citation count and finish reason are recorded in it. structured tells the format
+    the response was requested in.
+    """
+    sample = sample if sample is not None else {}
+    if on_update is None:
+        message = response.choices[0].message
+        record_usage(sample, response.usage)
+        sample["finish_reason"] = response.choices[0].finish_reason
+        sample["citations"] = count_citations(getattr(message, "context", None))
+        return message.content
+
+    content = ""
+    parser = response_parser.stream_parser(structured)
+    last_refresh = 0.0
+    for chunk in response:
+        record_usage(sample, getattr(chunk, "usage", None))
+        if chunk.choices:
+            citations = count_citations(getattr(chunk.choices[0].delta, "context", None))
+            if citations:
+                sample["citations"] = citations
+            if chunk.choices[0].finish_reason:
+                sample["finish_reason"] = chunk.choices[0].finish_reason
+        # Azure sends filter results and citations in chunks without content
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        if not content and "started_at" in sample:
+            sample["ttft_seconds"] = time.perf_counter() - sample["started_at"]
+        content += chunk.choices[0].delta.content
+        parser.feed(chunk.choices[0].delta.content)
+        if time.monotonic() - last_refresh >= STREAM_REFRESH_SECONDS:
+            on_update(*parser.result())
+            last_refresh = time.monotonic()
+    if "completion_tokens" not in sample:
+        # Streams only report usage when asked to, so count the tokens locally
+        sample["completion_tokens"] = count_tokens(content)
+    on_update(*response_parser.parse(content, structured))
+    return content
+
+
+def lookup(action: str, sys_prompt: str, task_description: str, code: str,
+           history: Optional[List[dict]], sample: dict) -> Tuple[str, Optional[Tuple[str, str]]]:
+    """Return the request's cache key and its cached (feedback, code), or None on a miss."""
+    key = response_cache.make_key(action, sys_prompt, task_description, code, model, search_index, history)
+    cached = response_cache.get_cache().get(key)
+    if cached is not None:
+        print(f"Response cache hit for {action}")
+        sample["cache_hit"] = True
+    return key, cached
+
+
+def plan_request(action: str, sys_prompt: str, task_description: str, code: str,
+                 history: Optional[List[dict]], sample: dict, stream: bool = False) -> Tuple[dict, int]:
+    """Build the request and size its max_tokens, returning it with the quota the first attempt reserves."""
+    request = build_request(action, sys_prompt, task_description, code, history)
+    tokens = token_budget.plan(action, request, sample)
+    if stream and STREAM_USAGE:
+        request["stream_options"] = {"include_usage": True}
+    return request, tokens
+
+
+def finish(key: str, flight: singleflight.Flight, content: str, structured: bool) -> Tuple[str, str]:
+    """Parse a complete response, cache it and pass it to the requests waiting on the flight."""
+    result = response_parser.parse(content, structured)
+    if result[0] or result[1]:
+        response_cache.get_cache().set(key, result)
+    flight.set_result(result)
+    return result
+
+
+def run_action(action: str, sys_prompt: str, task_description: str = "", code: str = "",
+               on_update: Optional[Callable[[str, str], None]] = None,
+               history: Optional[List[dict]] = None) -> Tuple[str, str]:
+    """Run an action and return (feedback, code).
+
+    Repeated requests are served from the response cache, and a request identical to
+    one still running waits for that one's result (see singleflight.py). When on_update
+    is given the response is streamed and on_update receives the partial feedback and code.
+    history holds earlier conversation messages to send before the prompt.
+    API errors are raised to the caller, and a prompt too large for the model raises
+    token_budget.PromptTooLargeError before it is sent. Every call is recorded in the
+    metrics.
+    """
+    with metrics.measure(action) as sample:
+        key, cached = lookup(action, sys_prompt, task_description, code, history, sample)
+        if cached is not None:
+            if on_update is not None:
+                on_update(*cached)
+            return cached
+
+        flight, leader = singleflight.join(key)
+        while not leader:
+            print(f"Joining an identical {action} request in flight")
+            sample["coalesced"] = True
+            result = flight.wait(on_update)
+            if result is not None:
+                return result
+            # The leader was cancelled, so this request may have to lead it
+            del sample["coalesced"]
+            flight, leader = singleflight.join(key)
+
+        with flight:
+            stream = on_update is not None
+            request, tokens = plan_request(action, sys_prompt, task_description, code, history, sample, stream)
+            structured = "response_format" in request
+
+            def update_and_publish(feedback: str, refined_code: str):
+                on_update(feedback, refined_code)
+                flight.publish(feedback, refined_code)
+
+            update = update_and_publish if stream else None
+            while tokens:
+                message = router.get_router().call(
+                    lambda backend: backend.client().chat.completions.with_raw_response.create(
+                        stream=stream, **dict(request, model=backend.deployment)
+                    ),
+                    tokens,
+                    sample
+                )
+                # print("Message: ", message)
+                content = read_content(message, update, sample, structured)
+                tokens = retry_tokens(action, request, sample, tokens)
+            return finish(key, flight, content, structured)
+
+
+def format_parts(results: List[Tuple[str, str]], include_code: bool) -> str:
+    """Format per-chunk results as the input of a reduce action."""
+    parts = []
+    for number, (feedback, refined_code) in enumerate(results, 1):
+        part = f"### Part {number}\nFeedback:\n{feedback}"
+        if include_code and refined_code:
+            part += f"\nContent:\n{refined_code}"
+        parts.append(part)
+    return "\n\n".join(parts)
+
+
+def needs_chunks(action: str, code: str) -> bool:
+    """Return whether the code is over the chunk budget of an action that can merge chunk results."""
+    return bool(ACTIONS[action].get("reduce")) and count_tokens(code) > CHUNK_MAX_TOKENS
+
+
+def run_chunked(action: str, sys_prompt: str, task_description: str = "", code: str = "",
+                on_update: Optional[Callable[[str, str], None]] = None,
+                history: Optional[List[dict]] = None) -> Tuple[str, str]:
+    """Run an action, splitting code over the chunk budget and merging the results.
+
+    Chunks follow top-level functions and classes and are analyzed in parallel, then the
+    action's reduce action merges their feedback. Unless the reduce action merges code
+    itself, the refined code of the chunks is joined in order. Every chunk is a separately
+    cached request, so editing one function only re-runs that chunk and the merge.
+    """
+    if not needs_chunks(action, code):
+        return run_action(action, sys_prompt, task_description, code, on_update, history)
+
+    chunks = split_code(code)
+    print(f"Splitting code for {action} into {len(chunks)} chunks")
+    with ThreadPoolExecutor(max_workers=max(1, BATCH_CONCURRENCY)) as pool:
+        results = list(pool.map(
+            lambda chunk: run_action(action, sys_prompt, task_description + CHUNK_NOTE, chunk, history=history),
+            chunks
+        ))
+
+    reduce_action = ACTIONS[action]["reduce"]
+    if ACTIONS[reduce_action].get("merges_code"):
+        return run_action(reduce_action, sys_prompt, task_description,
+                          format_parts(results, include_code=True), on_update, history)
+
+    joined_code = "\n\n".join(refined_code for _, refined_code in results if refined_code)
+    merge_update = None
+    if on_update is not None:
+        merge_update = lambda feedback, _: on_update(feedback, joined_code)
+    feedback, _ = run_action(reduce_action, sys_prompt, task_description,
+                             format_parts(results, include_code=False), merge_update, history)
+    return feedback, joined_code
+
+
+def retry_tokens(action: str, request: dict, sample: dict, tokens: int) -> int:
+    """Raise max_tokens to the ceiling when a learned limit cut the response off.
+
+    Returns the quota the retry reserves, or 0 when the response is complete or already
+    had the action's full max_tokens.
+    """
+    prompt_tokens = tokens - request["max_tokens"]
+    limit = token_budget.ceiling(ACTIONS[action]["max_tokens"], prompt_tokens)
+    if sample.get("finish_reason") != "length" or request["max_tokens"] >= limit:
+        return 0
+    print(f"{action} response reached max_tokens={request['max_tokens']}, retrying with {limit}")
+    request["max_tokens"] = sample["max_tokens"] = limit
+    sample["truncated_retries"] = sample.get("truncated_retries", 0) + 1
+    # The retry's usage replaces the cut off response's, and streams count it again
+    sample.pop("completion_tokens", None)
+    return prompt_tokens + limit
+
+
+async def arun_action(async_clients: router.AsyncClients, action: str, sys_prompt: str,
+                      task_description: str = "", code: str = "") -> Tuple[str, str]:
+    """Async version of run_action used for batches. Responses are not streamed and there is no history."""
+    with metrics.measure(action) as sample:
+        key, cached = lookup(action, sys_prompt, task_description, code, None, sample)
+        if cached is not None:
+            return cached
+
+        flight, leader = singleflight.join(key)
+        while not leader:
+            print(f"Joining an identical {action} request in flight")
+            sample["coalesced"] = True
+            result = await flight.wait_async()
+            if result is not None:
+                return result
+            del sample["coalesced"]
+            flight, leader = singleflight.join(key)
+
+        with flight:
+            request, tokens = plan_request(action, sys_prompt, task_description, code, None, sample)
+            structured = "response_format" in request
+            while tokens:
+                message = await router.get_router().call_async(
+                    lambda backend: async_clients.get(backend).chat.completions.with_raw_response.create(
+                        stream=False, **dict(request, model=backend.deployment)
+                    ),
+                    tokens,
+                    sample
+                )
+                content = read_content(message, sample=sample)
+                tokens = retry_tokens(action, request, sample, tokens)
+            return finish(key, flight, content, structured)
+
+
+async def run_batch(action: str, sys_prompt: str, task_description: str, files: Dict[str, str],
+                    concurrency: int = BATCH_CONCURRENCY) -> AsyncIterator[Tuple[str, str, str, str]]:
+    """Run an action over many files concurrently.
+
+    Yields (file name, feedback, code, error) as each file completes, so the slowest
+    files decide the total time. At most `concurrency` files are processed at once and
+    all requests go through the process-wide router and its rate limiters. Files over
+    the chunk budget are split and merged by run_chunked on a thread.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async with router.AsyncClients() as async_clients:
+        async def run_file(name: str, code: str):
+            async with semaphore:
+                try:
+                    if needs_chunks(action, code):
+                        feedback, refined_code = await asyncio.get_running_loop().run_in_executor(
+                            None, run_chunked, action, sys_prompt, task_description, code
+                        )
+                    else:
+                        feedback, refined_code = await arun_action(
+                            async_clients, action, sys_prompt, task_description, code
+                        )
+                    return name, feedback, refined_code, ""
+                except Exception as e:
+                    return name, "", "", str(e)
+
+        tasks = [asyncio.create_task(run_file(name, code)) for name, code in files.items()]
+        try:
+            for completed in asyncio.as_completed(tasks):
+                yield await completed
+        finally:
+            for task in tasks:
+                task.cancel()
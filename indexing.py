@@ -0,0 +1,207 @@
+"""Incremental indexing of uploaded files into Azure AI Search.
+
+Running the blob indexer reprocesses the whole container, and users ran it after
+every upload, so runs collided and the index lagged. Instead:
+
+- index_files chunks uploaded text files, optionally embeds the chunks, and pushes
+  them as merge-or-upload batches keyed by a content hash, so a file is searchable
+  seconds after it is uploaded and unchanged chunks are rewritten in place.
+  This needs an index with the key, content, title and (optional) vector fields
+  named below, and is enabled with INCREMENTAL_INDEXING=true.
+- IndexerTrigger debounces and coalesces requests for a full indexer run and polls
+  the indexer's status in the background.
+"""
+import hashlib
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import clients
+import ratelimit
+from chunking import count_tokens, split_code
+
+INCREMENTAL_INDEXING = os.getenv("INCREMENTAL_INDEXING", "false").lower() == "true"
+INDEX_CHUNK_TOKENS = int(os.getenv("INDEX_CHUNK_TOKENS", "800"))
+INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", "100"))
+KEY_FIELD = os.getenv("AZURE_AI_SEARCH_KEY_FIELD", "id")
+CONTENT_FIELD = os.getenv("AZURE_AI_SEARCH_CONTENT_FIELD", "content")
+TITLE_FIELD = os.getenv("AZURE_AI_SEARCH_TITLE_FIELD", "title")
+# Leave empty to push text only and let the index's vectorizer or keyword search handle it
+VECTOR_FIELD = os.getenv("AZURE_AI_SEARCH_VECTOR_FIELD", "")
+EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "")
+
+INDEXER_DEBOUNCE_SECONDS = float(os.getenv("INDEXER_DEBOUNCE_SECONDS", "30"))
+INDEXER_POLL_SECONDS = float(os.getenv("INDEXER_POLL_SECONDS", "10"))
+
+
+def chunk_key(name: str, chunk: str) -> str:
+    """Return the document key of a chunk: a hash of its file name and content."""
+    return hashlib.sha256(f"{name}\n{chunk}".encode("utf-8")).hexdigest()
+
+
+def embed(texts: List[str]) -> List[List[float]]:
+    """Embed texts with the Azure OpenAI embedding deployment, through the rate limiter."""
+    response = ratelimit.get_limiter().call(
+        lambda: clients.openai_client().embeddings.with_raw_response.create(
+            model=EMBEDDING_DEPLOYMENT, input=texts
+        ),
+        sum(count_tokens(text) for text in texts)
+    )
+    return [item.embedding for item in response.data]
+
+
+def build_documents(name: str, text: str) -> List[dict]:
+    """Split a file into chunks and return one search document per chunk."""
+    chunks = [chunk for chunk in split_code(text, INDEX_CHUNK_TOKENS) if chunk.strip()]
+    documents = [{KEY_FIELD: chunk_key(name, chunk), CONTENT_FIELD: chunk, TITLE_FIELD: name} for chunk in chunks]
+    if VECTOR_FIELD and EMBEDDING_DEPLOYMENT and documents:
+        for start in range(0, len(documents), INDEX_BATCH_SIZE):
+            batch = documents[start:start + INDEX_BATCH_SIZE]
+            for document, vector in zip(batch, embed([d[CONTENT_FIELD] for d in batch])):
+                document[VECTOR_FIELD] = vector
+    return documents
+
+
+def _stale_keys(name: str, keys: set) -> List[str]:
+    """Return keys of documents from an earlier version of the file."""
+    escaped = name.replace("'", "''")
+    results = clients.search_client().search(
+        search_text="*", filter=f"{TITLE_FIELD} eq '{escaped}'", select=[KEY_FIELD]
+    )
+    return [result[KEY_FIELD] for result in results if result[KEY_FIELD] not in keys]
+
+
+def index_files(files: Dict[str, memoryview]) -> Dict[str, int]:
+    """Push the chunks of uploaded text files to the search index.
+
+    Returns {name: number of chunks indexed}. Binary files are skipped, and chunks left
+    over from an earlier version of a file are deleted.
+    """
+    # Imported here so the Azure SDK only loads once a file is indexed (see clients.py)
+    from azure.search.documents import IndexDocumentsBatch
+
+    indexed = {}
+    for name, data in files.items():
+        try:
+            text = bytes(data).decode("utf-8")
+        except UnicodeDecodeError:
+            print(f"Skipping binary file {name} for indexing")
+            continue
+        documents = build_documents(name, text)
+        keys = {document[KEY_FIELD] for document in documents}
+        for start in range(0, len(documents), INDEX_BATCH_SIZE):
+            batch = IndexDocumentsBatch()
+            batch.add_merge_or_upload_actions(documents[start:start + INDEX_BATCH_SIZE])
+            clients.search_client().index_documents(batch)
+        try:
+            stale = _stale_keys(name, keys)
+        except Exception as e:
+            # The title field may not be filterable in this index
+            print(f"Could not look up old chunks of {name}: {e}")
+            stale = []
+        if stale:
+            batch = IndexDocumentsBatch()
+            batch.add_delete_actions([{KEY_FIELD: key} for key in stale])
+            clients.search_client().index_documents(batch)
+        indexed[name] = len(documents)
+    return indexed
+
+
+class IndexerTrigger:
+    """Debounced runs of the search indexer, shared by every session in the process.
+
+    Requests within INDEXER_DEBOUNCE_SECONDS of each other coalesce into one run, and a
+    request while the indexer is busy is retried once it finishes. After a run starts
+    the indexer status is polled until it completes.
+    """
+
+    def __init__(self, indexer_name: str, delay: float = INDEXER_DEBOUNCE_SECONDS):
+        self.indexer_name = indexer_name
+        self.delay = delay
+        self.scheduled_at: Optional[float] = None
+        self.last_status: Optional[dict] = None
+        self.last_error: Optional[str] = None
+        self._timer: Optional[threading.Timer] = None
+        self._polling = False
+        self._lock = threading.Lock()
+
+    def request(self):
+        """Ask for an indexer run; restarts the debounce delay."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self.scheduled_at = time.time() + self.delay
+            self._timer = threading.Timer(self.delay, self._run)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _run(self):
+        with self._lock:
+            self._timer = None
+            self.scheduled_at = None
+        try:
+            if self.refresh_status().get("running"):
+                print("Indexer is busy, re-scheduling the run")
+                self.request()
+                return
+            clients.indexer_client().run_indexer(self.indexer_name)
+            print("Re-indexing triggered")
+            self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)
+            return
+        self._start_polling()
+
+    def _start_polling(self):
+        with self._lock:
+            if self._polling:
+                return
+            self._polling = True
+        threading.Thread(target=self._poll, daemon=True).start()
+
+    def _poll(self):
+        try:
+            # The run shows up in the status a moment after it is accepted
+            time.sleep(INDEXER_POLL_SECONDS)
+            while self.refresh_status().get("running"):
+                time.sleep(INDEXER_POLL_SECONDS)
+        except Exception as e:
+            self.last_error = str(e)
+        finally:
+            self._polling = False
+
+    def status(self) -> dict:
+        """Return the indexer status, fetching it again when it is older than the poll interval."""
+        last = self.last_status
+        if last is None or time.time() - last["fetched_at"] >= INDEXER_POLL_SECONDS:
+            return self.refresh_status()
+        return last
+
+    def refresh_status(self) -> dict:
+        """Fetch the indexer status from the service."""
+        status = clients.indexer_client().get_indexer_status(self.indexer_name)
+        last = status.last_result
+        self.last_status = {
+            "status": status.status,
+            "running": last is not None and last.status == "inProgress",
+            "last_result": last.status if last else None,
+            "items": last.item_count if last else 0,
+            "failed_items": last.failed_item_count if last else 0,
+            "end_time": last.end_time if last else None,
+            "fetched_at": time.time(),
+        }
+        return self.last_status
+
+
+_trigger = None
+_trigger_lock = threading.Lock()
+
+
+def get_trigger() -> IndexerTrigger:
+    """Return the indexer trigger shared by every session in this process."""
+    global _trigger
+    with _trigger_lock:
+        if _trigger is None:
+            _trigger = IndexerTrigger(clients.search_indexer)
+        return _trigger
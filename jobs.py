@@ -0,0 +1,181 @@
+"""Background jobs for completions.
+
+A completion used to run in the Streamlit script thread, so a rerun triggered by any
+widget abandoned the request after its tokens were paid for. Jobs run on a
+process-wide worker pool instead: the script submits a job, gets its ID, and polls
+for the partial and final output. Finished jobs are kept for JOB_TTL_SECONDS, in
+memory or, with JOB_STORE=sqlite, in a SQLite file shared by every worker process,
+so a reloaded page can reattach to its job through the ?job= query parameter.
+
+Jobs still queued or running when their process stops are not resumed.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional
+
+import engine
+import response_cache
+
+if TYPE_CHECKING:
+    from conversation import Conversation
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_STORE = os.getenv("JOB_STORE", "memory").lower()
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "jobs.sqlite3")
+JOB_TTL_SECONDS = float(os.getenv("JOB_TTL_SECONDS", "86400"))
+# How often the UI checks a running job
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "0.5"))
+
+FINISHED = ("done", "error")
+
+
+class MemoryJobStore:
+    """Jobs of this process, kept in a dict."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def save(self, job: dict):
+        with self._lock:
+            self._jobs[job["id"]] = dict(job)
+
+    def load(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def prune(self, before: float):
+        with self._lock:
+            for job_id in [job_id for job_id, job in self._jobs.items() if job["updated_at"] < before]:
+                del self._jobs[job_id]
+
+
+class SQLiteJobStore:
+    """Jobs in a SQLite file shared by every worker process."""
+
+    def __init__(self, path: str = JOB_STORE_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, value TEXT NOT NULL, updated REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return response_cache.thread_connection(self._local, self.path)
+
+    def save(self, job: dict):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO jobs (id, value, updated) VALUES (?, ?, ?)",
+                         (job["id"], json.dumps(job), job["updated_at"]))
+
+    def load(self, job_id: str) -> Optional[dict]:
+        row = self._connect().execute("SELECT value FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def prune(self, before: float):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE updated < ?", (before,))
+
+
+class JobQueue:
+    """Worker pool running actions in the background.
+
+    The store receives every status change; the partial output of running jobs is
+    only kept in memory, where the UI reads it while the job streams.
+    """
+
+    def __init__(self, store, workers: int = JOB_WORKERS):
+        self.store = store
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="job")
+        self._live = {}
+        self._lock = threading.Lock()
+
+    def submit(self, action: str, sys_prompt: str, task_description: str = "", code: str = "",
+               conversation: Optional["Conversation"] = None, stream: bool = False) -> str:
+        """Queue an action and return the job ID.
+
+        With a conversation, the worker sends its earlier turns as history, compacting
+        them first when they are over budget, and sends a reference instead of `code`
+        when the model has already seen it. The job records `code` either way.
+        """
+        now = time.time()
+        job = {
+            "id": uuid.uuid4().hex,
+            "action": action,
+            "task_description": task_description,
+            "code": code,
+            "status": "queued",
+            "feedback": "",
+            "refined_code": "",
+            "error": "",
+            "created_at": now,
+            "updated_at": now,
+        }
+        with self._lock:
+            self._live[job["id"]] = job
+        self.store.prune(now - JOB_TTL_SECONDS)
+        self.store.save(job)
+        self._pool.submit(self._run, job, sys_prompt, conversation, stream)
+        return job["id"]
+
+    def _update(self, job: dict, persist: bool = False, **fields):
+        with self._lock:
+            job.update(fields, updated_at=time.time())
+            snapshot = dict(job)
+        if persist:
+            self.store.save(snapshot)
+
+    def _run(self, job: dict, sys_prompt: str, conversation: Optional["Conversation"], stream: bool):
+        self._update(job, persist=True, status="running")
+        on_update = None
+        if stream:
+            on_update = lambda feedback, refined_code: self._update(job, feedback=feedback, refined_code=refined_code)
+        try:
+            history, request_code = None, job["code"]
+            if conversation is not None:
+                # Compacting runs a summary completion, so it belongs here and not in the UI
+                history, request_code = conversation.prepare(sys_prompt, job["code"])
+            feedback, refined_code = engine.run_chunked(
+                job["action"], sys_prompt, job["task_description"], request_code, on_update, history
+            )
+            self._update(job, persist=True, status="done", feedback=feedback, refined_code=refined_code)
+        except Exception as e:
+            print(f"Job {job['id']} failed: {e}")
+            self._update(job, persist=True, status="error", error=str(e))
+        finally:
+            with self._lock:
+                self._live.pop(job["id"], None)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """Return a copy of the job, including the partial output of a running job."""
+        with self._lock:
+            job = self._live.get(job_id)
+            if job is not None:
+                return dict(job)
+        return self.store.load(job_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            statuses = [job["status"] for job in self._live.values()]
+        return {"queued": statuses.count("queued"), "running": statuses.count("running")}
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue() -> JobQueue:
+    """Return the job queue shared by every session in this process."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue(SQLiteJobStore() if JOB_STORE == "sqlite" else MemoryJobStore())
+        return _queue
@@ -0,0 +1,219 @@
+"""Per-request latency and token metrics.
+
+The engine records one sample per completion: wall time, time spent queued in the
+rate limiter, time to first token, prompt/completion tokens, number of retrieval
+citations and whether the response cache or an identical request in flight
+(coalesced) answered it. Samples are kept per
+action in memory for the sidebar's percentile table, exported in Prometheus text
+format on METRICS_PORT (when set), and emitted as OpenTelemetry spans when the
+opentelemetry package is installed.
+"""
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Dict, List
+
+try:
+    from opentelemetry import trace
+    tracer = trace.get_tracer("code-assistant")
+except ImportError:
+    tracer = None
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Samples kept per action for the percentiles
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "1000"))
+# How often the sidebar panel refreshes
+PANEL_REFRESH_SECONDS = 5
+
+FIELDS = ("wall_seconds", "queue_seconds", "ttft_seconds", "prompt_tokens", "completion_tokens",
+          "cached_tokens", "citations")
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Return the q-th quantile of values by linear interpolation."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def answered(sample: dict) -> bool:
+    """Return whether the service answered the request itself: not from the cache, coalesced or failed."""
+    return not sample.get("cache_hit") and not sample.get("coalesced") and not sample.get("error")
+
+
+class MetricsRecorder:
+    """Thread-safe store of recent request samples and running totals per action."""
+
+    def __init__(self, window: int = METRICS_WINDOW):
+        self._samples: Dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+        self._totals: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self._lock = threading.Lock()
+
+    def record(self, sample: dict):
+        with self._lock:
+            action = sample["action"]
+            self._samples[action].append(sample)
+            totals = self._totals[action]
+            totals["requests"] += 1
+            totals["cache_hits"] += bool(sample.get("cache_hit"))
+            totals["coalesced"] += bool(sample.get("coalesced"))
+            totals["errors"] += bool(sample.get("error"))
+            if answered(sample):
+                totals["answered"] += 1
+                totals["answered_seconds"] += sample["wall_seconds"]
+            for field in FIELDS:
+                totals[field] += sample.get(field) or 0
+
+    def samples(self, action: str) -> List[dict]:
+        with self._lock:
+            return list(self._samples.get(action, ()))
+
+    def summary(self) -> List[dict]:
+        """Return one row per action with request counts and latency percentiles."""
+        with self._lock:
+            actions = {action: list(samples) for action, samples in self._samples.items()}
+        rows = []
+        for action, samples in sorted(actions.items()):
+            sent = [s for s in samples if answered(s)]
+            wall = [s["wall_seconds"] for s in sent]
+            ttft = [s["ttft_seconds"] for s in sent if s.get("ttft_seconds") is not None]
+            rows.append({
+                "action": action,
+                "requests": len(samples),
+                "cache hit %": round(100 * sum(bool(s.get("cache_hit")) for s in samples) / len(samples)),
+                "coalesced %": round(100 * sum(bool(s.get("coalesced")) for s in samples) / len(samples)),
+                "errors": sum(bool(s.get("error")) for s in samples),
+                "p50 s": round(percentile(wall, 0.5), 2),
+                "p95 s": round(percentile(wall, 0.95), 2),
+                "p99 s": round(percentile(wall, 0.99), 2),
+                "ttft p50 s": round(percentile(ttft, 0.5), 2) if ttft else None,
+                "queue p95 s": round(percentile([s.get("queue_seconds") or 0 for s in sent], 0.95), 2),
+                "avg prompt tokens": round(sum(s.get("prompt_tokens") or 0 for s in sent) / max(1, len(sent))),
+                "avg completion tokens": round(sum(s.get("completion_tokens") or 0 for s in sent) / max(1, len(sent))),
+                "avg max_tokens": round(sum(s.get("max_tokens") or 0 for s in sent) / max(1, len(sent))),
+                "cached prompt %": round(100 * sum(s.get("cached_tokens") or 0 for s in sent)
+                                         / max(1, sum(s.get("prompt_tokens") or 0 for s in sent))),
+                "avg citations": round(sum(s.get("citations") or 0 for s in sent) / max(1, len(sent)), 1),
+            })
+        return rows
+
+    def prometheus_text(self) -> str:
+        """Render the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            actions = {action: list(samples) for action, samples in self._samples.items()}
+            totals = {action: dict(values) for action, values in self._totals.items()}
+        lines = [
+            "# HELP code_assistant_request_seconds Wall time of requests the service answered; cache hits, coalesced requests and errors are counted separately.",
+            "# TYPE code_assistant_request_seconds summary",
+        ]
+        for action, samples in sorted(actions.items()):
+            wall = [s["wall_seconds"] for s in samples if answered(s)]
+            for q in QUANTILES:
+                lines.append(f'code_assistant_request_seconds{{action="{action}",quantile="{q}"}} {percentile(wall, q):.6f}')
+            lines.append(f'code_assistant_request_seconds_sum{{action="{action}"}} {totals[action].get("answered_seconds", 0):.6f}')
+            lines.append(f'code_assistant_request_seconds_count{{action="{action}"}} {int(totals[action].get("answered", 0))}')
+        lines.append("# HELP code_assistant_ttft_seconds Time to first token over recent streamed requests.")
+        lines.append("# TYPE code_assistant_ttft_seconds summary")
+        for action, samples in sorted(actions.items()):
+            ttft = [s["ttft_seconds"] for s in samples if s.get("ttft_seconds") is not None]
+            if not ttft:
+                continue
+            for q in QUANTILES:
+                lines.append(f'code_assistant_ttft_seconds{{action="{action}",quantile="{q}"}} {percentile(ttft, q):.6f}')
+        for name, field, help_text in (
+            ("requests_total", "requests", "Requests handled."),
+            ("cache_hits_total", "cache_hits", "Requests answered by the response cache."),
+            ("coalesced_total", "coalesced", "Requests answered by an identical request in flight."),
+            ("errors_total", "errors", "Requests that failed."),
+            ("queue_seconds_total", "queue_seconds", "Time spent waiting in the rate limiter."),
+            ("prompt_tokens_total", "prompt_tokens", "Prompt tokens sent."),
+            ("completion_tokens_total", "completion_tokens", "Completion tokens received."),
+            ("cached_tokens_total", "cached_tokens", "Prompt tokens served from the server's prompt cache."),
+            ("citations_total", "citations", "Retrieval citations returned."),
+        ):
+            lines.append(f"# HELP code_assistant_{name} {help_text}")
+            lines.append(f"# TYPE code_assistant_{name} counter")
+            for action, values in sorted(totals.items()):
+                lines.append(f'code_assistant_{name}{{action="{action}"}} {values.get(field, 0):g}')
+        return "\n".join(lines) + "\n"
+
+
+recorder = MetricsRecorder()
+
+
+@contextmanager
+def measure(action: str):
+    """Time a request and record it.
+
+    The caller fills in the yielded sample dict; its started_at is the perf_counter
+    value at the start, used to compute the time to first token.
+    """
+    start = time.perf_counter()
+    sample = {"action": action, "started_at": start, "cache_hit": False, "error": None}
+    span = tracer.start_span(f"completion {action}") if tracer is not None else None
+    try:
+        yield sample
+    except Exception as e:
+        sample["error"] = e.__class__.__name__
+        raise
+    finally:
+        sample["wall_seconds"] = time.perf_counter() - start
+        recorder.record(sample)
+        if span is not None:
+            span.set_attribute("action", action)
+            for key, value in sample.items():
+                if key not in ("action", "started_at") and value is not None:
+                    span.set_attribute(f"code_assistant.{key}", value)
+            span.end()
+
+
+def _serve_metrics(handler):
+    """Answer a GET request of the metrics HTTP server."""
+    if handler.path.split("?")[0] != "/metrics":
+        handler.send_error(404)
+        return
+    body = recorder.prometheus_text().encode("utf-8")
+    handler.send_response(200)
+    handler.send_header("Content-Type", "text/plain; version=0.0.4")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_server(port: int = METRICS_PORT):
+    """Serve /metrics on the port once per process and return the server. Does nothing when the port is 0."""
+    global _server
+    if not port or _server is not None:
+        return _server
+    # Imported here so processes without a metrics port do not load http.server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        do_GET = _serve_metrics
+
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+            except OSError as e:
+                # Another worker process already serves the port
+                print(f"Metrics endpoint not started on port {port}: {e}")
+                return None
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+            print(f"Metrics available on http://0.0.0.0:{port}/metrics")
+        return _server
@@ -0,0 +1,432 @@
+"""Local stand-in for the Azure OpenAI chat completions endpoint, Blob Storage and AI Search.
+
+Lets the rate limiter, retry logic and the upload and indexing paths be exercised
+without live Azure resources. The chat endpoint enforces its own requests-per-minute
+and tokens-per-minute limits, answers over-quota requests with 429 and retry-after
+like Azure does, sends the x-ratelimit-remaining-* headers, can inject random
+throttling and server errors, and streams at a configurable token rate:
+
+    python mock_aoai.py --port 8089 --rpm 20 --tpm 40000 --throttle-rate 0.1
+
+then run the app with AZURE_OPENAI_ENDPOINT=http://127.0.0.1:8089. The same server
+keeps blobs and search documents in memory and answers the blob and search calls
+the app makes; point the app at it with
+
+    AZURE_STORAGE_CONNECTION_STRING=DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;AccountKey=a2V5;BlobEndpoint=http://127.0.0.1:8089/devstoreaccount1
+    AZURE_AI_SEARCH_ENDPOINT=http://127.0.0.1:8089
+
+The indexer client only accepts https endpoints, so indexer runs are not mocked;
+use INCREMENTAL_INDEXING=true to index uploads through the search stand-in.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+# Account name of the blob stand-in, the same as the Azurite emulator's
+ACCOUNT_NAME = "devstoreaccount1"
+
+
+def connection_string(port: int) -> str:
+    """Return the storage connection string for a mock server on the port."""
+    # The key is never checked; it only has to be valid base64
+    return (f"DefaultEndpointsProtocol=http;AccountName={ACCOUNT_NAME};AccountKey=a2V5;"
+            f"BlobEndpoint=http://127.0.0.1:{port}/{ACCOUNT_NAME}")
+
+
+class MockState:
+    """Quota windows and settings shared by all requests to one mock server."""
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, latency: float = 0.2,
+                 throttle_rate: float = 0.0, chunk_delay: float = 0.01, token_rate: float = 0.0,
+                 error_rate: float = 0.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        # Fraction of requests answered with 500, like a failing region
+        self.error_rate = error_rate
+        self.chunk_delay = chunk_delay
+        # Completion tokens generated per second; 0 sends them as fast as chunk_delay allows
+        self.token_rate = token_rate
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.blobs = {}
+        self.blocks = {}
+        self.documents = {}
+        self.prefixes = set()
+        self._window = deque()
+        self._lock = threading.Lock()
+
+    def admit(self, tokens: int):
+        """Record a request if it fits the last minute's quota.
+
+        Returns (retry_after, remaining_requests, remaining_tokens); retry_after is None
+        when the request is admitted.
+        """
+        with self._lock:
+            now = time.monotonic()
+            while self._window and now - self._window[0][0] >= 60:
+                self._window.popleft()
+            used_tokens = sum(spent for _, spent in self._window)
+            over_requests = self.rpm and len(self._window) + 1 > self.rpm
+            over_tokens = self.tpm and used_tokens + tokens > self.tpm
+            if over_requests or over_tokens or random.random() < self.throttle_rate:
+                self.throttled += 1
+                # Injected throttling is brief; an exhausted quota frees up as the window slides
+                retry_after = 1
+                if (over_requests or over_tokens) and self._window:
+                    retry_after = 60 - (now - self._window[0][0])
+                return max(1, int(retry_after)), self._remaining(len(self._window), used_tokens)
+            self.requests += 1
+            self._window.append((now, tokens))
+            return None, self._remaining(len(self._window), used_tokens + tokens)
+
+    def cached_tokens(self, messages: list) -> int:
+        """Return the prompt tokens a prompt cache would serve for these messages.
+
+        Like Azure, only the longest previously seen prefix of whole messages counts,
+        prompts under 1024 tokens are never cached, and hits come in 128-token steps.
+        """
+        prefix = hashlib.sha256()
+        tokens = cached = 0
+        with self._lock:
+            for message in messages:
+                prefix.update(json.dumps(message, sort_keys=True).encode("utf-8"))
+                tokens += len(message.get("content") or "") // 4
+                digest = prefix.hexdigest()
+                if digest in self.prefixes:
+                    cached = tokens
+                self.prefixes.add(digest)
+        return cached // 128 * 128 if cached >= 1024 else 0
+
+    def generation_seconds(self, tokens: int) -> float:
+        """Time the model takes to generate `tokens` completion tokens."""
+        return tokens / self.token_rate if self.token_rate else 0.0
+
+    def _remaining(self, requests: int, tokens: int):
+        return (self.rpm - requests if self.rpm else 1000000,
+                self.tpm - tokens if self.tpm else 10000000)
+
+
+def mock_content(prompt: str, structured: bool = False) -> str:
+    """Build a reply in the app's ---FEEDBACK---/---CODE--- format that echoes the prompt's code.
+
+    With structured=True the reply is a JSON object in the app's response schema.
+    """
+    # The code of the request comes last, after any history and context
+    blocks = re.findall(r"```python\n(.*?)```", prompt, re.DOTALL)
+    code = blocks[-1].strip() if blocks else 'print("Hello from the mock endpoint")'
+    feedback = (
+        f"Mock review of a {len(prompt)} character prompt.\n"
+        "- The code is syntactically plausible.\n"
+        "- Consider adding tests.\n"
+    )
+    if structured:
+        return json.dumps({
+            "feedback": feedback,
+            "code_blocks": [{"language": "python", "code": code}],
+            "citations": [],
+        })
+    return f"---FEEDBACK---\n{feedback}---CODE---\n{code}\n"
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = MockState()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict, headers: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _send(self, status: int, data: bytes = b"", headers: dict = None, content_type: str = None):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        if path.startswith("/indexes("):
+            self._search(path, json.loads(self._read_body() or b"{}"))
+            return
+        body = json.loads(self._read_body() or b"{}")
+        if not path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"code": "NotFound", "message": self.path}}, {})
+            return
+
+        if random.random() < self.state.error_rate:
+            self.state.errors += 1
+            self._send_json(500, {"error": {"code": "InternalServerError", "message": "Injected failure"}}, {})
+            return
+        prompt = "\n".join(message.get("content") or "" for message in body.get("messages", []))
+        prompt_tokens = len(prompt) // 4 + 1
+        retry_after, (remaining_requests, remaining_tokens) = self.state.admit(
+            prompt_tokens + body.get("max_tokens", 1000)
+        )
+        headers = {
+            "x-ratelimit-remaining-requests": remaining_requests,
+            "x-ratelimit-remaining-tokens": remaining_tokens,
+        }
+        if retry_after is not None:
+            headers["retry-after"] = retry_after
+            self._send_json(429, {"error": {
+                "code": "429",
+                "message": f"Rate limit exceeded. Try again in {retry_after} seconds."
+            }}, headers)
+            return
+
+        time.sleep(self.state.latency)
+        structured = (body.get("response_format") or {}).get("type") == "json_schema"
+        content = mock_content(prompt, structured)
+        finish_reason = "stop"
+        if len(content) // 4 + 1 > body.get("max_tokens", 1000):
+            content, finish_reason = content[:body.get("max_tokens", 1000) * 4], "length"
+        completion_tokens = len(content) // 4 + 1
+        if not body.get("stream"):
+            time.sleep(self.state.generation_seconds(completion_tokens))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = body.get("model") or "mock"
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": self.state.cached_tokens(body.get("messages", []))},
+        }
+        if body.get("stream"):
+            include_usage = (body.get("stream_options") or {}).get("include_usage")
+            self._stream(completion_id, model, content, headers, usage if include_usage else None, finish_reason)
+            return
+        self._send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "finish_reason": finish_reason,
+                "message": {"role": "assistant", "content": content},
+            }],
+            "usage": usage,
+        }, headers)
+
+    def _stream(self, completion_id: str, model: str, content: str, headers: dict, usage: dict = None,
+                finish_reason: str = "stop"):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        for name, value in headers.items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.close_connection = True
+
+        def send(choices, usage=None):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": choices, "usage": usage}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        # Azure starts with a chunk that has no choices, carrying the prompt filter results
+        send([])
+        # Each chunk carries about one token
+        delay = self.state.generation_seconds(1) or self.state.chunk_delay
+        for start in range(0, len(content), 4):
+            send([{"index": 0, "finish_reason": None, "delta": {"content": content[start:start + 4]}}])
+            time.sleep(delay)
+        send([{"index": 0, "finish_reason": finish_reason, "delta": {}}])
+        if usage is not None:
+            # Requested with stream_options, the usage follows in a chunk without choices
+            send([], usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    # Blob Storage: the calls made by storage.upload_file and retrieval.read_container
+
+    def _blob_path(self):
+        """Return (container, blob name, query) for a blob request, or None for other paths."""
+        url = urlsplit(self.path)
+        parts = url.path.split("/", 3)
+        if len(parts) < 3 or parts[1] != ACCOUNT_NAME:
+            return None
+        return parts[2], unquote(parts[3]) if len(parts) > 3 else "", parse_qs(url.query)
+
+    def _blob_headers(self, data: bytes, content_md5: str) -> dict:
+        return {
+            "ETag": f'"0x{hashlib.md5(data).hexdigest()[:16].upper()}"',
+            "Last-Modified": formatdate(usegmt=True),
+            "x-ms-blob-type": "BlockBlob",
+            "x-ms-request-server-encrypted": "true",
+            "Content-MD5": content_md5,
+            "x-ms-version": "2021-08-06",
+        }
+
+    def do_PUT(self):
+        target = self._blob_path()
+        if target is None:
+            self._send(404)
+            return
+        container, name, query = target
+        data = self._read_body()
+        comp = query.get("comp", [""])[0]
+        with self.state._lock:
+            if comp == "block":
+                self.state.blocks[(container, name, query["blockid"][0])] = data
+                self._send(201, headers={"x-ms-request-server-encrypted": "true"})
+                return
+            if comp == "blocklist":
+                block_ids = re.findall(r"<(?:Latest|Uncommitted|Committed)>(.*?)</", data.decode("utf-8"))
+                data = b"".join(self.state.blocks.pop((container, name, block_id), b"") for block_id in block_ids)
+        content_md5 = self.headers.get("x-ms-blob-content-md5") or base64.b64encode(hashlib.md5(data).digest()).decode()
+        with self.state._lock:
+            self.state.blobs[(container, name)] = (data, content_md5)
+        self._send(201, headers=self._blob_headers(data, content_md5))
+
+    def do_HEAD(self):
+        target = self._blob_path()
+        blob = self.state.blobs.get(target[:2]) if target else None
+        if blob is None:
+            self._send(404, headers={"x-ms-error-code": "BlobNotFound"})
+            return
+        data, content_md5 = blob
+        headers = self._blob_headers(data, content_md5)
+        headers["Content-Length"] = len(data)
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, str(value))
+        self.end_headers()
+
+    def do_GET(self):
+        target = self._blob_path()
+        if target is None:
+            self._send(404)
+            return
+        container, name, query = target
+        if query.get("comp") == ["list"]:
+            blobs = "".join(
+                f"<Blob><Name>{escape(blob_name)}</Name><Properties><Content-Length>{len(data)}</Content-Length>"
+                f"<BlobType>BlockBlob</BlobType></Properties></Blob>"
+                for (blob_container, blob_name), (data, _) in sorted(self.state.blobs.items())
+                if blob_container == container
+            )
+            xml = (f'<?xml version="1.0" encoding="utf-8"?><EnumerationResults ContainerName="{escape(container)}">'
+                   f"<Blobs>{blobs}</Blobs><NextMarker /></EnumerationResults>")
+            self._send(200, xml.encode("utf-8"), content_type="application/xml")
+            return
+        blob = self.state.blobs.get((container, name))
+        if blob is None:
+            self._send(404, headers={"x-ms-error-code": "BlobNotFound"})
+            return
+        data, content_md5 = blob
+        headers = self._blob_headers(data, content_md5)
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("x-ms-range") or self.headers.get("Range") or "")
+        if match and data:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+            self._send(206, data[start:end + 1], headers, "application/octet-stream")
+            return
+        self._send(200, data, headers, "application/octet-stream")
+
+    # AI Search: document indexing and filtered search
+
+    def _search(self, path: str, body: dict):
+        match = re.match(r"/indexes\('([^']*)'\)/(.*)", path)
+        if match is None:
+            self._send_json(404, {"error": {"code": "NotFound", "message": path}}, {})
+            return
+        name, operation = match.groups()
+        documents = self.state.documents.setdefault(name, {})
+        if operation == "docs/search.index":
+            results = []
+            with self.state._lock:
+                for action in body.get("value", []):
+                    verb = action.pop("@search.action", "upload")
+                    # The app sends the key field first
+                    key = next(iter(action.values()))
+                    if verb == "delete":
+                        documents.pop(key, None)
+                    elif verb in ("merge", "mergeOrUpload"):
+                        documents.setdefault(key, {}).update(action)
+                    else:
+                        documents[key] = action
+                    results.append({"key": key, "status": True, "errorMessage": None, "statusCode": 200})
+            self._send_json(200, {"value": results}, {})
+        elif operation == "docs/search.post.search":
+            matches = list(documents.values())
+            field_filter = re.match(r"(\w+) eq '(.*)'$", body.get("filter") or "")
+            if field_filter:
+                field, value = field_filter.group(1), field_filter.group(2).replace("''", "'")
+                matches = [d for d in matches if d.get(field) == value]
+            select = [field for field in (body.get("select") or "").split(",") if field]
+            if select:
+                matches = [{field: d.get(field) for field in select} for d in matches]
+            self._send_json(200, {"value": [dict(d, **{"@search.score": 1.0}) for d in matches]}, {})
+        else:
+            self._send_json(404, {"error": {"code": "NotFound", "message": path}}, {})
+
+
+def serve(port: int = 0, **settings) -> ThreadingHTTPServer:
+    """Start a mock server on a background thread and return it; port 0 picks a free port."""
+    handler = type("Handler", (MockHandler,), {"state": MockState(**settings)})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--rpm", type=int, default=0, help="requests per minute before 429s (0 = unlimited)")
+    parser.add_argument("--tpm", type=int, default=0, help="tokens per minute before 429s (0 = unlimited)")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="seconds between streamed chunks")
+    parser.add_argument("--token-rate", type=float, default=0.0,
+                        help="completion tokens generated per second (0 = use --chunk-delay)")
+    args = parser.parse_args()
+
+    server = serve(args.port, rpm=args.rpm, tpm=args.tpm, latency=args.latency,
+                   throttle_rate=args.throttle_rate, chunk_delay=args.chunk_delay,
+                   token_rate=args.token_rate, error_rate=args.error_rate)
+    port = server.server_address[1]
+    print(f"Mock Azure OpenAI endpoint listening on http://127.0.0.1:{port}")
+    print(f"Mock storage connection string: {connection_string(port)}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""Client-side rate limiting and retries for Azure OpenAI.
+
+The deployment is shared by every session in a worker, so one RateLimiter per
+process queues requests against the deployment's requests-per-minute and
+tokens-per-minute quotas before they are sent. The x-ratelimit-remaining-* and
+retry-after headers of each response keep the buckets in line with the server,
+and throttled or failed calls are retried with jittered exponential backoff
+instead of being shown to the user as errors.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from functools import lru_cache
+from typing import Callable, Optional
+
+REQUESTS_PER_MINUTE = int(os.getenv("AZURE_OPENAI_REQUESTS_PER_MINUTE", "0"))
+TOKENS_PER_MINUTE = int(os.getenv("AZURE_OPENAI_TOKENS_PER_MINUTE", "0"))
+MAX_RETRIES = int(os.getenv("AZURE_OPENAI_MAX_RETRIES", "6"))
+BACKOFF_BASE_SECONDS = float(os.getenv("AZURE_OPENAI_BACKOFF_BASE_SECONDS", "1"))
+BACKOFF_MAX_SECONDS = float(os.getenv("AZURE_OPENAI_BACKOFF_MAX_SECONDS", "60"))
+# How often queued requests check whether it is their turn
+POLL_SECONDS = 0.05
+
+
+@lru_cache(maxsize=None)
+def retryable_errors() -> tuple:
+    """Return the openai exceptions worth retrying.
+
+    openai is imported here rather than at the top of the module so importing the
+    app does not load it; except clauses only evaluate this when a call has failed.
+    """
+    import openai
+    return (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+
+def is_throttled(error: Exception) -> bool:
+    """Return whether a failed call was throttled (429)."""
+    import openai
+    return isinstance(error, openai.RateLimitError)
+
+
+class TokenBucket:
+    """Bucket holding up to `per_minute` units, refilled continuously. 0 means unlimited."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` units are available."""
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60 / self.capacity
+
+    def take(self, amount: float):
+        if self.capacity:
+            self.level -= min(amount, self.capacity)
+
+    def limit(self, remaining: float, now: float):
+        """Lower the level to what the server reports as remaining."""
+        if self.capacity:
+            self._refill(now)
+            self.level = min(self.level, remaining)
+
+
+def retry_after_seconds(headers) -> Optional[float]:
+    """Return the server's requested delay from retry-after-ms or retry-after, if any."""
+    if headers is None:
+        return None
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(name)
+        if value:
+            try:
+                return float(value) * scale
+            except ValueError:
+                continue
+    return None
+
+
+class RateLimiter:
+    """Process-wide FIFO queue in front of the deployment's RPM and TPM quotas."""
+
+    def __init__(self, requests_per_minute: int = REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.paused_until = 0.0
+        self.throttled = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+        self._next_ticket = 0
+        self._serving = 0
+        self._abandoned = set()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of requests waiting for quota."""
+        return self._next_ticket - self._serving - len(self._abandoned)
+
+    def _take_ticket(self) -> int:
+        with self._lock:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            return ticket
+
+    def _advance(self):
+        self._serving += 1
+        while self._serving in self._abandoned:
+            self._abandoned.discard(self._serving)
+            self._serving += 1
+
+    def _abandon(self, ticket: int):
+        with self._lock:
+            if ticket == self._serving:
+                self._advance()
+            elif ticket > self._serving:
+                self._abandoned.add(ticket)
+
+    def _try_acquire(self, ticket: int, tokens: int) -> float:
+        """Reserve quota for the ticket and return 0, or return how long to wait."""
+        with self._lock:
+            if ticket != self._serving:
+                return POLL_SECONDS
+            now = time.monotonic()
+            delay = max(self.paused_until - now,
+                        self.requests.wait_time(1, now),
+                        self.tokens.wait_time(tokens, now))
+            if delay > 0:
+                return min(delay, 1.0)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self._advance()
+            return 0.0
+
+    def wait_time(self, tokens: int) -> float:
+        """Seconds until a request of `tokens` tokens could be sent, ignoring requests already queued."""
+        with self._lock:
+            now = time.monotonic()
+            return max(self.paused_until - now,
+                       self.requests.wait_time(1, now),
+                       self.tokens.wait_time(tokens, now))
+
+    def acquire(self, tokens: int):
+        """Block until a request of `tokens` tokens may be sent."""
+        ticket = self._take_ticket()
+        try:
+            while True:
+                delay = self._try_acquire(ticket, tokens)
+                if not delay:
+                    return
+                time.sleep(delay)
+        except BaseException:
+            self._abandon(ticket)
+            raise
+
+    async def acquire_async(self, tokens: int):
+        """Wait without blocking the event loop until a request may be sent."""
+        ticket = self._take_ticket()
+        try:
+            while True:
+                delay = self._try_acquire(ticket, tokens)
+                if not delay:
+                    return
+                await asyncio.sleep(delay)
+        except BaseException:
+            self._abandon(ticket)
+            raise
+
+    def update_from_headers(self, headers):
+        """Sync the buckets with the x-ratelimit-remaining-* headers of a response."""
+        if headers is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            for name, bucket in (("x-ratelimit-remaining-requests", self.requests),
+                                 ("x-ratelimit-remaining-tokens", self.tokens)):
+                value = headers.get(name)
+                if value is not None:
+                    try:
+                        bucket.limit(float(value), now)
+                    except ValueError:
+                        pass
+
+    def backoff(self, attempt: int, headers=None) -> float:
+        """Return the delay before retry `attempt`: the server's retry-after or jittered exponential backoff."""
+        retry_after = retry_after_seconds(headers)
+        if retry_after is not None:
+            return retry_after + random.uniform(0, BACKOFF_BASE_SECONDS)
+        delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def pause(self, seconds: float):
+        """Hold every queued request for `seconds`, used when the deployment is throttling."""
+        with self._lock:
+            self.throttled += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def record_error(self, error: Exception, attempt: int) -> float:
+        """Sync the limiter with a failed call, pausing the queue when throttled, and return the retry delay."""
+        headers = getattr(getattr(error, "response", None), "headers", None)
+        self.update_from_headers(headers)
+        delay = self.backoff(attempt, headers)
+        if is_throttled(error):
+            self.pause(delay)
+        with self._lock:
+            self.retries += 1
+        return delay
+
+    def call(self, send: Callable, tokens: int, sample: Optional[dict] = None):
+        """Send a request through the queue, retrying throttled and failed calls.
+
+        `send` must return a raw response (client.with_raw_response); its headers update
+        the buckets and the parsed response is returned. When a metrics sample dict is
+        given, the time spent queued and backing off and the number of retries are added to it.
+        """
+        waited = 0.0
+        try:
+            for attempt in range(MAX_RETRIES + 1):
+                start = time.perf_counter()
+                self.acquire(tokens)
+                waited += time.perf_counter() - start
+                try:
+                    raw = send()
+                except retryable_errors() as e:
+                    if attempt == MAX_RETRIES:
+                        raise
+                    delay = self.record_error(e, attempt)
+                    print(f"Azure OpenAI call failed ({e.__class__.__name__}), retry {attempt + 1} in {delay:.1f}s")
+                    waited += delay
+                    if sample is not None:
+                        sample["retries"] = attempt + 1
+                    time.sleep(delay)
+                    continue
+                self.update_from_headers(raw.headers)
+                return raw.parse()
+        finally:
+            if sample is not None:
+                sample["queue_seconds"] = waited
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            self.requests._refill(now)
+            self.tokens._refill(now)
+            return {
+                "queue_depth": self.queue_depth,
+                "requests_available": int(self.requests.level) if self.requests.capacity else None,
+                "tokens_available": int(self.tokens.level) if self.tokens.capacity else None,
+                "paused_for": max(0.0, self.paused_until - now),
+                "throttled": self.throttled,
+                "retries": self.retries,
+            }
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter() -> RateLimiter:
+    """Return the limiter shared by every session in this process."""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
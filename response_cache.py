@@ -0,0 +1,199 @@
+"""Response cache for Azure OpenAI completions.
+
+Every action runs with temperature=0, so an identical request gives the same
+answer. The cache sits in front of the chat-completion call and returns the
+stored (feedback, code) pair for a repeated request instead of paying for
+another completion and search retrieval.
+
+Two backends are available, selected with RESPONSE_CACHE_BACKEND:
+  memory - in-process LRU (default), private to one Streamlit worker
+  sqlite - on-disk file at RESPONSE_CACHE_PATH, shared by all worker processes
+  none   - caching disabled
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory").lower()
+CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "86400"))
+CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "512"))
+
+
+def normalize(text: Optional[str]) -> str:
+    """Normalize line endings and trailing whitespace so cosmetic edits still hit."""
+    if not text:
+        return ""
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+def make_key(action: str, sys_prompt: str, task_description: str, code: str,
+             model: str, search_index: str, history: Optional[List[dict]] = None) -> str:
+    """Return the cache key for a request, including its conversation history if any."""
+    parts = [action, normalize(sys_prompt), normalize(task_description), normalize(code),
+             model or "", search_index or ""]
+    if history:
+        parts.append([[m["role"], normalize(m["content"])] for m in history])
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+def thread_connection(local: threading.local, path: str) -> sqlite3.Connection:
+    """Return the calling thread's WAL-mode connection to a SQLite file, opening it on first use."""
+    # sqlite3 connections cannot be shared between threads, so keep one per thread
+    conn = getattr(local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        local.conn = conn
+    return conn
+
+
+class MemoryCache:
+    """In-process LRU cache with a TTL."""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: str, value: Tuple[str, str]):
+        with self._lock:
+            self._entries[key] = (time.time(), tuple(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "entries": len(self), "hits": self.hits, "misses": self.misses}
+
+
+class SQLiteCache:
+    """On-disk LRU cache with a TTL, shared between processes through one SQLite file.
+
+    Hit/miss counters are per process.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, max_entries: int = CACHE_MAX_ENTRIES,
+                 ttl: float = CACHE_TTL_SECONDS):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return thread_connection(self._local, self.path)
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return tuple(json.loads(row[0]))
+
+    def set(self, key: str, value: Tuple[str, str]):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(list(value)), now, now),
+            )
+            conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM responses")
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def stats(self) -> dict:
+        return {"backend": "sqlite", "entries": len(self), "hits": self.hits, "misses": self.misses}
+
+
+class NullCache:
+    """Cache that never stores anything."""
+
+    hits = 0
+    misses = 0
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        return None
+
+    def set(self, key: str, value: Tuple[str, str]):
+        pass
+
+    def clear(self):
+        pass
+
+    def __len__(self):
+        return 0
+
+    def stats(self) -> dict:
+        return {"backend": "none", "entries": 0, "hits": 0, "misses": 0}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the process-wide cache for the configured backend."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            if CACHE_BACKEND == "sqlite":
+                _cache = SQLiteCache()
+            elif CACHE_BACKEND == "none":
+                _cache = NullCache()
+            else:
+                _cache = MemoryCache()
+        return _cache
@@ -0,0 +1,306 @@
+"""Parsing of completion responses into (feedback, code).
+
+Actions ask for one of two formats:
+  text       - ---FEEDBACK--- and ---CODE--- sections (OUTPUT_FORMAT in engine.py)
+  structured - a JSON object matching RESPONSE_SCHEMA, enforced by the service
+               through response_format
+
+parse() reads a complete response. It does not give up when a response drifts
+from the requested format: reformatted or missing markers, a JSON object in a
+text response and, as a last resort, markdown code fences are recognized, so the
+code still lands in the code section instead of the whole answer in the feedback.
+The stream parsers read a streamed response incrementally, looking at every
+delta once, and return the partial feedback and code on demand.
+"""
+import json
+import re
+from typing import Optional, Tuple
+
+FEEDBACK_MARKER = "---FEEDBACK---"
+CODE_MARKER = "---CODE---"
+
+# Markers as models actually write them: any case, extra spaces or dashes
+FEEDBACK_PATTERN = re.compile(r"-{2,}\s*FEEDBACK\s*-{2,}", re.IGNORECASE)
+CODE_PATTERN = re.compile(r"-{2,}\s*CODE\s*-{2,}", re.IGNORECASE)
+FENCE_PATTERN = re.compile(r"^[ \t]*```[ \t]*([\w+#.-]*)[ \t]*\n(.*?)^[ \t]*```[ \t]*$", re.DOTALL | re.MULTILINE)
+
+RESPONSE_SCHEMA = {
+    "name": "assistant_response",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "feedback": {
+                "type": "string",
+                "description": "The response text, in markdown",
+            },
+            "code_blocks": {
+                "type": "array",
+                "description": "The code or documents asked for, without markdown fences",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "language": {"type": "string"},
+                        "code": {"type": "string"},
+                    },
+                    "required": ["language", "code"],
+                    "additionalProperties": False,
+                },
+            },
+            "citations": {
+                "type": "array",
+                "description": "Names of the provided documents the response is based on",
+                "items": {"type": "string"},
+            },
+        },
+        "required": ["feedback", "code_blocks", "citations"],
+        "additionalProperties": False,
+    },
+}
+
+RESPONSE_FORMAT = {"type": "json_schema", "json_schema": RESPONSE_SCHEMA}
+
+
+def from_structured(data: dict) -> Tuple[str, str]:
+    """Return (feedback, code) for a response object, joining its code blocks in order."""
+    feedback = str(data.get("feedback") or "").strip()
+    citations = [c.strip() for c in data.get("citations") or [] if isinstance(c, str) and c.strip()]
+    if citations:
+        feedback += "\n\nSources: " + ", ".join(citations)
+    blocks = [block.get("code") for block in data.get("code_blocks") or [] if isinstance(block, dict)]
+    return feedback, "\n\n".join(code.strip() for code in blocks if isinstance(code, str) and code.strip())
+
+
+def load_structured(content: str) -> Optional[dict]:
+    """Return the response object in the content, or None when it is not one."""
+    text = content.strip()
+    match = FENCE_PATTERN.fullmatch(text)
+    if match:
+        text = match.group(2).strip()
+    if not text.startswith("{"):
+        return None
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not ("feedback" in data or "code_blocks" in data):
+        return None
+    return data
+
+
+def unfence(code: str) -> str:
+    """Remove a markdown fence wrapped around a whole code section."""
+    code = code.strip()
+    match = FENCE_PATTERN.fullmatch(code)
+    return match.group(2).strip() if match else code
+
+
+def parse_text(content: str) -> Tuple[str, str]:
+    """Return (feedback, code) for a text response, tolerating deviations from the markers."""
+    code_match = CODE_PATTERN.search(content)
+    if code_match:
+        head = content[:code_match.start()]
+        feedback_match = FEEDBACK_PATTERN.search(head)
+        feedback = head[feedback_match.end():] if feedback_match else head
+        return feedback.strip(), unfence(content[code_match.end():])
+
+    data = load_structured(content)
+    if data is not None:
+        return from_structured(data)
+
+    content = FEEDBACK_PATTERN.sub("", content, count=1)
+    blocks = [code.strip() for _, code in FENCE_PATTERN.findall(content)]
+    if blocks:
+        # No code section, so take the code from the fenced blocks
+        return FENCE_PATTERN.sub("", content).strip(), "\n\n".join(block for block in blocks if block)
+    return content.strip(), ""
+
+
+def parse(content: str, structured: bool = False) -> Tuple[str, str]:
+    """Return (feedback, code) for a complete response in the requested format."""
+    if structured:
+        data = load_structured(content)
+        if data is not None:
+            return from_structured(data)
+        print("Structured response is not valid JSON, parsing it as text")
+    return parse_text(content)
+
+
+class SectionStreamParser:
+    """Incremental parser for streamed ---FEEDBACK---/---CODE--- responses.
+
+    Text before the feedback marker is held back and dropped when the marker arrives,
+    or becomes the feedback when the code marker comes first, as in parse(). A
+    response without markers therefore only shows once parse() reads it in full. The
+    end of a delta that could be the start of a marker is held back until the next
+    delta shows whether it is.
+    """
+
+    def __init__(self):
+        self._section = "start"
+        self._pending = ""
+        self._preamble = ""
+        self._feedback = ""
+        self._code = ""
+
+    def _markers(self):
+        if self._section == "start":
+            return (FEEDBACK_MARKER, CODE_MARKER)
+        if self._section == "feedback":
+            return (CODE_MARKER,)
+        return ()
+
+    def feed(self, text: str):
+        self._pending += text
+        while self._pending:
+            markers = self._markers()
+            found = [(self._pending.find(marker), marker) for marker in markers if marker in self._pending]
+            if found:
+                index, marker = min(found)
+                self._append(self._pending[:index])
+                self._pending = self._pending[index + len(marker):]
+                if marker == FEEDBACK_MARKER:
+                    self._section = "feedback"
+                else:
+                    if self._section == "start":
+                        self._feedback = self._preamble
+                    self._section = "code"
+                continue
+            held = 0
+            for marker in markers:
+                for size in range(min(len(marker) - 1, len(self._pending)), held, -1):
+                    if self._pending.endswith(marker[:size]):
+                        held = size
+                        break
+            self._append(self._pending[:len(self._pending) - held])
+            self._pending = self._pending[len(self._pending) - held:]
+            break
+
+    def _append(self, text: str):
+        if self._section == "start":
+            self._preamble += text
+        elif self._section == "code":
+            self._code += text
+        else:
+            self._feedback += text
+
+    def result(self) -> Tuple[str, str]:
+        return self._feedback.strip(), self._code.strip()
+
+
+class JsonStreamParser:
+    """Incremental parser for streamed structured responses.
+
+    A small JSON tokenizer that follows the nesting of the response object and
+    decodes the feedback and code strings as they arrive, escapes included. Citations
+    are only added by parse() once the response is complete.
+    """
+
+    _SPECIAL = re.compile(r'["\\]')
+    _ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f", '"': '"', "\\": "\\", "/": "/"}
+
+    def __init__(self):
+        # One entry per open container: [kind, key of the current member, expecting a key]
+        self._stack = []
+        self._in_string = False
+        self._target = None
+        self._key = ""
+        self._escape = ""
+        self._high_surrogate = None
+        self._feedback = ""
+        self._code = ""
+
+    def _string_target(self) -> Optional[str]:
+        """Return where the string starting now goes: the member key, feedback, code or nowhere."""
+        if self._stack and self._stack[-1][0] == "object" and self._stack[-1][2]:
+            return "key"
+        path = [entry[1] for entry in self._stack if entry[0] == "object"]
+        if path == ["feedback"] and len(self._stack) == 1:
+            return "feedback"
+        if path == ["code_blocks", "code"] and len(self._stack) == 3:
+            return "code"
+        return None
+
+    def _emit(self, text: str):
+        if self._target == "feedback":
+            self._feedback += text
+        elif self._target == "code":
+            self._code += text
+        elif self._target == "key":
+            self._key += text
+
+    def _unescape(self, char: str):
+        self._escape += char
+        if self._escape[1] != "u":
+            self._emit(self._ESCAPES.get(char, char))
+            self._escape = ""
+            return
+        if len(self._escape) < 6:
+            return
+        value = int(self._escape[2:], 16)
+        self._escape = ""
+        if 0xD800 <= value < 0xDC00:
+            self._high_surrogate = value
+            return
+        if 0xDC00 <= value < 0xE000 and self._high_surrogate is not None:
+            value = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (value - 0xDC00)
+        self._high_surrogate = None
+        self._emit(chr(value))
+
+    def feed(self, text: str):
+        index = 0
+        while index < len(text):
+            if self._in_string:
+                if self._escape:
+                    self._unescape(text[index])
+                    index += 1
+                    continue
+                match = self._SPECIAL.search(text, index)
+                end = match.start() if match else len(text)
+                self._emit(text[index:end])
+                index = end
+                if match is None:
+                    break
+                if text[index] == "\\":
+                    self._escape = "\\"
+                else:
+                    self._end_string()
+                index += 1
+                continue
+
+            char = text[index]
+            if char == '"':
+                self._in_string = True
+                self._target = self._string_target()
+                if self._target == "key":
+                    self._key = ""
+                elif self._target == "code" and self._code.strip():
+                    self._code = self._code.rstrip() + "\n\n"
+            elif char == "{":
+                self._stack.append(["object", None, True])
+            elif char == "[":
+                self._stack.append(["array", None, False])
+            elif char in "}]":
+                if self._stack:
+                    self._stack.pop()
+            elif char == ",":
+                if self._stack and self._stack[-1][0] == "object":
+                    self._stack[-1][2] = True
+            elif char == ":":
+                if self._stack:
+                    self._stack[-1][2] = False
+            index += 1
+
+    def _end_string(self):
+        self._in_string = False
+        if self._target == "key":
+            self._stack[-1][1] = self._key
+        self._target = None
+
+    def result(self) -> Tuple[str, str]:
+        return self._feedback.strip(), self._code.strip()
+
+
+def stream_parser(structured: bool = False):
+    """Return an incremental parser for a response in the requested format."""
+    return JsonStreamParser() if structured else SectionStreamParser()
@@ -0,0 +1,245 @@
+"""Local retrieval over the uploaded container contents.
+
+Every completion with the azure_search data source pays for a server-side
+retrieval, even when the question has nothing to do with the indexed code. With
+LOCAL_RETRIEVAL=true the engine instead searches an in-process NumPy vector index
+built from the container, injects the best snippets into the prompt itself, and
+skips retrieval entirely when nothing scores above RETRIEVAL_THRESHOLD.
+
+The index is stored in LOCAL_INDEX_PATH as a .npy matrix of unit vectors, opened
+memory-mapped, plus a JSON list of the chunks. Vectors come from the Azure OpenAI
+embedding deployment when AZURE_OPENAI_EMBEDDING_DEPLOYMENT is set, otherwise from
+a local feature-hashing embedder so retrieval also works offline. The embedder that
+built the index is saved with it; after switching embedders retrieval is skipped
+until the index is rebuilt. NumPy is only
+imported once the local index is used, so it does not slow down the app's startup.
+"""
+import json
+import math
+import os
+import re
+import threading
+import zlib
+from collections import Counter
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import clients
+import indexing
+from chunking import split_code
+
+if TYPE_CHECKING:
+    import numpy as np
+
+LOCAL_RETRIEVAL = os.getenv("LOCAL_RETRIEVAL", "false").lower() == "true"
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "local_index")
+RETRIEVAL_THRESHOLD = float(os.getenv("RETRIEVAL_THRESHOLD", "0.2"))
+# Dimensions of the local hashing embedder
+HASH_DIMENSIONS = int(os.getenv("HASH_DIMENSIONS", "1024"))
+# Longest query text embedded, in characters
+MAX_QUERY_CHARS = 8000
+
+
+def _terms(text: str) -> List[str]:
+    """Split text into lower-case words, also splitting snake_case and camelCase identifiers."""
+    terms = []
+    for word in re.findall(r"[A-Za-z_][A-Za-z0-9_]*|\d+", text):
+        parts = [p for p in re.split(r"_|(?<=[a-z0-9])(?=[A-Z])", word) if p]
+        terms.append(word.lower())
+        if len(parts) > 1:
+            terms.extend(part.lower() for part in parts)
+    return terms
+
+
+def hash_embed(texts: List[str]) -> "np.ndarray":
+    """Embed texts locally by hashing their terms into HASH_DIMENSIONS signed buckets."""
+    import numpy as np
+    vectors = np.zeros((len(texts), HASH_DIMENSIONS), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for term, count in Counter(_terms(text)).items():
+            digest = zlib.crc32(term.encode("utf-8"))
+            sign = 1.0 if digest & 0x80000000 else -1.0
+            vectors[row, digest % HASH_DIMENSIONS] += sign * (1.0 + math.log(count))
+    return vectors
+
+
+def embedder_name() -> str:
+    """Return the name of the configured embedder, which vectors of other embedders cannot be compared with."""
+    if indexing.EMBEDDING_DEPLOYMENT:
+        return f"azure:{indexing.EMBEDDING_DEPLOYMENT}"
+    return f"hash:{HASH_DIMENSIONS}"
+
+
+def embed(texts: List[str]) -> "np.ndarray":
+    """Return unit-length embeddings for texts."""
+    import numpy as np
+    if indexing.EMBEDDING_DEPLOYMENT:
+        vectors = np.asarray(indexing.embed(texts), dtype=np.float32)
+    else:
+        vectors = hash_embed(texts)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class VectorIndex:
+    """Brute-force cosine-similarity index over unit vectors, persisted as a memory-mapped .npy file."""
+
+    def __init__(self, path: str = LOCAL_INDEX_PATH):
+        self.path = path
+        self.documents: List[dict] = []
+        self.vectors: Optional["np.ndarray"] = None
+        # Embedder that built the loaded vectors, None for indexes saved without it
+        self.embedder: Optional[str] = None
+        self._loaded_mtime = None
+        self._warned_mtime = None
+        self._lock = threading.Lock()
+
+    @property
+    def _vectors_file(self) -> str:
+        return os.path.join(self.path, "vectors.npy")
+
+    @property
+    def _documents_file(self) -> str:
+        return os.path.join(self.path, "documents.json")
+
+    @property
+    def _embedder_file(self) -> str:
+        return os.path.join(self.path, "embedder.json")
+
+    def __len__(self):
+        return len(self.documents)
+
+    def load(self):
+        """Load the index from disk if another process or session has changed it."""
+        import numpy as np
+        try:
+            mtime = os.path.getmtime(self._documents_file)
+        except OSError:
+            return
+        if mtime == self._loaded_mtime:
+            return
+        with open(self._documents_file, "r", encoding="utf-8") as f:
+            documents = json.load(f)
+        try:
+            with open(self._embedder_file, "r", encoding="utf-8") as f:
+                embedder = json.load(f)["embedder"]
+        except (OSError, ValueError, KeyError):
+            embedder = None
+        vectors = np.load(self._vectors_file, mmap_mode="r") if documents else None
+        self.documents, self.vectors, self.embedder, self._loaded_mtime = documents, vectors, embedder, mtime
+
+    def stale(self, dimensions: int) -> bool:
+        """Return whether the loaded vectors come from another embedder than the configured one."""
+        if self.vectors is None:
+            return False
+        if self.embedder is not None and self.embedder != embedder_name():
+            return True
+        return self.vectors.shape[1] != dimensions
+
+    def save(self):
+        import numpy as np
+        os.makedirs(self.path, exist_ok=True)
+        # Write the vectors first: readers check the documents file to detect changes
+        if self.vectors is not None and len(self.documents):
+            with open(self._vectors_file + ".tmp", "wb") as f:
+                np.save(f, np.ascontiguousarray(self.vectors, dtype=np.float32))
+            os.replace(self._vectors_file + ".tmp", self._vectors_file)
+        with open(self._embedder_file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"embedder": embedder_name(),
+                       "dimensions": int(self.vectors.shape[1]) if self.vectors is not None else None}, f)
+        os.replace(self._embedder_file + ".tmp", self._embedder_file)
+        with open(self._documents_file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.documents, f)
+        os.replace(self._documents_file + ".tmp", self._documents_file)
+        self._loaded_mtime = None
+        self.load()
+
+    def replace_files(self, files: Dict[str, str], clear: bool = False,
+                      chunk_tokens: int = indexing.INDEX_CHUNK_TOKENS):
+        """Index the files' chunks, replacing chunks previously indexed for the same names.
+
+        With clear=True every other document is dropped as well.
+        """
+        import numpy as np
+        new_documents = []
+        for name, text in files.items():
+            new_documents.extend({"title": name, "content": chunk}
+                                 for chunk in split_code(text, chunk_tokens) if chunk.strip())
+        new_vectors = embed([d["content"] for d in new_documents]) if new_documents else None
+        with self._lock:
+            self.load()
+            if not clear and new_vectors is not None and self.stale(new_vectors.shape[1]):
+                print("Dropping the local index built with another embedder")
+                clear = True
+            keep = [] if clear else [i for i, d in enumerate(self.documents) if d["title"] not in files]
+            documents = [self.documents[i] for i in keep] + new_documents
+            parts = []
+            if keep and self.vectors is not None:
+                parts.append(np.asarray(self.vectors[keep]))
+            if new_vectors is not None:
+                parts.append(new_vectors)
+            self.documents = documents
+            self.vectors = np.vstack(parts) if parts else None
+            self.save()
+
+    def search(self, query: str, k: int, threshold: float = RETRIEVAL_THRESHOLD) -> List[Tuple[float, dict]]:
+        """Return up to k (score, document) pairs scoring at least threshold, best first."""
+        import numpy as np
+        self.load()
+        documents, vectors = self.documents, self.vectors
+        if not documents or vectors is None or k <= 0:
+            return []
+        query_vector = embed([query[:MAX_QUERY_CHARS]])[0]
+        if self.stale(len(query_vector)):
+            if self._warned_mtime != self._loaded_mtime:
+                self._warned_mtime = self._loaded_mtime
+                print(f"Skipping local retrieval: the index was built with {self.embedder or 'another embedder'}, "
+                      f"not {embedder_name()}. Rebuild the local index.")
+            return []
+        scores = vectors @ query_vector
+        top = np.argsort(-scores)[:k]
+        return [(float(scores[i]), documents[i]) for i in top if scores[i] >= threshold]
+
+
+def read_container() -> Dict[str, str]:
+    """Download the text blobs of the storage container."""
+    container = clients.container_client()
+    files = {}
+    for blob in container.list_blobs():
+        data = container.download_blob(blob.name, max_concurrency=4).readall()
+        try:
+            files[blob.name] = data.decode("utf-8")
+        except UnicodeDecodeError:
+            print(f"Skipping binary blob {blob.name}")
+    return files
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> VectorIndex:
+    """Return the local index shared by every session in this process."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = VectorIndex()
+            _index.load()
+        return _index
+
+
+def rebuild_index() -> int:
+    """Rebuild the local index from the whole container and return the number of chunks."""
+    index = get_index()
+    index.replace_files(read_container(), clear=True)
+    return len(index)
+
+
+def retrieve(query: str, k: int) -> List[dict]:
+    """Return the chunks relevant to the query, or nothing when no chunk passes the threshold."""
+    return [document for _, document in get_index().search(query, k)]
+
+
+def format_context(documents: List[dict]) -> str:
+    """Format retrieved chunks for the prompt."""
+    sections = [f"[doc{n}] {d['title']}\n{d['content'].strip()}" for n, d in enumerate(documents, 1)]
+    return "Relevant documents from the indexed code base:\n\n" + "\n\n".join(sections)
@@ -0,0 +1,362 @@
+"""Routing of chat completions across several Azure OpenAI deployments.
+
+One deployment caps the app at its tokens-per-minute quota and its region's
+latency. AZURE_OPENAI_BACKENDS lists several deployments as a JSON array:
+
+    [{"name": "eastus", "endpoint": "https://a.openai.azure.com", "deployment": "gpt-4o",
+      "api_key_env": "EASTUS_OPENAI_KEY", "weight": 2, "tokens_per_minute": 150000},
+     {"name": "westeurope", "endpoint": "https://b.openai.azure.com", "deployment": "gpt-4o",
+      "api_key_env": "WESTEUROPE_OPENAI_KEY", "api_version": "2024-09-01-preview"}]
+
+deployment, api_version and the key (api_key, or the environment variable named by
+api_key_env) default to the AZURE_OPENAI_* settings. Every backend has its own rate
+limiter, with requests_per_minute and tokens_per_minute as its quota.
+
+Each request goes to the healthy backend with the lowest score: the time its limiter
+would make the request wait, plus its observed latency times its requests in flight
+divided by its weight, plus penalties for recent consecutive failures and for a last
+x-ratelimit-remaining-tokens header below the request's size. A throttled (429) or failed (5xx or connection
+error) call fails over to another backend right away; only when every backend has
+failed does the request back off. CIRCUIT_FAILURES consecutive failures open a
+backend's circuit: it gets no requests for CIRCUIT_OPEN_SECONDS, then a single probe
+request decides whether it closes again.
+
+Without AZURE_OPENAI_BACKENDS there is one backend, built from the AZURE_OPENAI_*
+settings and using the process-wide limiter, so requests behave as before.
+Embeddings always use that deployment.
+"""
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
+
+import clients
+import ratelimit
+
+if TYPE_CHECKING:
+    from openai import AsyncAzureOpenAI, AzureOpenAI
+
+BACKENDS = os.getenv("AZURE_OPENAI_BACKENDS", "")
+CIRCUIT_FAILURES = int(os.getenv("AZURE_OPENAI_CIRCUIT_FAILURES", "3"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("AZURE_OPENAI_CIRCUIT_OPEN_SECONDS", "30"))
+# Weight of the newest call in a backend's average latency
+LATENCY_SMOOTHING = 0.2
+# How long a remaining-tokens header is trusted: the length of the quota window
+REMAINING_TOKENS_SECONDS = 60
+# Added to the score of a backend that reported fewer remaining tokens than a request needs
+EXHAUSTED_PENALTY_SECONDS = 60
+# Added to the score of a backend for each of its consecutive failures, for
+# CIRCUIT_OPEN_SECONDS after the last one; failures are often quick, so a failing
+# backend would otherwise look fast
+FAILURE_PENALTY_SECONDS = 5
+
+
+class Backend:
+    """One Azure OpenAI deployment with its rate limiter, load and health."""
+
+    def __init__(self, name: str, endpoint: str, deployment: str, api_key: str, api_version: str,
+                 weight: float = 1.0, limiter: Optional[ratelimit.RateLimiter] = None,
+                 client_factory: Optional[Callable[[], "AzureOpenAI"]] = None):
+        self.name = name
+        self.endpoint = endpoint
+        self.deployment = deployment
+        self.api_key = api_key
+        self.api_version = api_version
+        self.weight = max(float(weight), 0.01)
+        self.limiter = limiter or ratelimit.RateLimiter(0, 0)
+        self._client_factory = client_factory
+        self._client = None
+        self._client_lock = threading.Lock()
+        # Updated by the router under its lock
+        self.in_flight = 0
+        self.latency = 0.0
+        self.remaining_tokens = None
+        self.remaining_at = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0
+        self.failed_at = 0.0
+        self.open_until = 0.0
+        self.probing = False
+
+    def client(self) -> "AzureOpenAI":
+        """Return the backend's client, built on first use."""
+        with self._client_lock:
+            if self._client is None:
+                if self._client_factory is not None:
+                    self._client = self._client_factory()
+                else:
+                    self._client = clients.make_openai_client(self.endpoint, self.api_key, self.api_version)
+            return self._client
+
+    def async_client(self) -> "AsyncAzureOpenAI":
+        return clients.make_async_openai_client(self.endpoint, self.api_key, self.api_version)
+
+    def available(self, now: float) -> bool:
+        """Return whether the circuit lets a request through: closed, or open long enough to probe."""
+        return not self.open_until or (now >= self.open_until and not self.probing)
+
+    def score(self, tokens: int, now: float) -> float:
+        """Return the expected cost in seconds of sending a request of `tokens` tokens here."""
+        score = self.limiter.wait_time(tokens) + self.latency * (self.in_flight + 1) / self.weight
+        if now - self.failed_at < CIRCUIT_OPEN_SECONDS:
+            score += self.failures * FAILURE_PENALTY_SECONDS
+        if (self.remaining_tokens is not None and self.remaining_tokens < tokens
+                and now - self.remaining_at < REMAINING_TOKENS_SECONDS):
+            score += EXHAUSTED_PENALTY_SECONDS
+        return score
+
+    def state(self, now: float) -> str:
+        if not self.open_until:
+            return "healthy"
+        return "probing" if self.probing or now >= self.open_until else "open"
+
+
+class AsyncClients:
+    """Async clients of the backends for one event loop, closed together at the end.
+
+    Async connections belong to the event loop that opened them, and every batch runs
+    in its own loop, so each batch opens its own clients.
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, "AsyncAzureOpenAI"] = {}
+
+    def get(self, backend: Backend) -> "AsyncAzureOpenAI":
+        if backend.name not in self._clients:
+            self._clients[backend.name] = backend.async_client()
+        return self._clients[backend.name]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for client in self._clients.values():
+            await client.close()
+
+
+class Router:
+    """Picks a backend for each request and fails over between them."""
+
+    def __init__(self, backends: List[Backend]):
+        self.backends = backends
+        self.failovers = 0
+        self._lock = threading.Lock()
+
+    def _choose(self, tokens: int, failed: List[Backend]) -> Backend:
+        """Return the backend for the next attempt, preferring those that have not failed this request."""
+        with self._lock:
+            now = time.monotonic()
+            available = [b for b in self.backends if b.available(now)]
+            # When every circuit is open the request still goes somewhere rather than failing
+            candidates = [b for b in available if b not in failed] or available or self.backends
+            # Equal scores, such as idle backends without a latency yet, are split by weight
+            backend = min(candidates, key=lambda b: (b.score(tokens, now), -random.random() ** (1 / b.weight)))
+            if backend.open_until and now >= backend.open_until:
+                backend.probing = True
+            backend.in_flight += 1
+            return backend
+
+    def _has_alternative(self, failed: List[Backend]) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            return any(b not in failed and b.available(now) for b in self.backends)
+
+    def _finish(self, backend: Backend, sent_at: Optional[float], headers=None,
+                error: Optional[Exception] = None):
+        """Record the outcome of a call: its latency, the remaining tokens and the backend's health."""
+        with self._lock:
+            now = time.monotonic()
+            backend.in_flight -= 1
+            if sent_at is None:
+                # Not sent, or failed for a reason that says nothing about the backend's health
+                return
+            backend.requests += 1
+            remaining = headers.get("x-ratelimit-remaining-tokens") if headers is not None else None
+            if remaining is not None:
+                try:
+                    backend.remaining_tokens = float(remaining)
+                    backend.remaining_at = now
+                except ValueError:
+                    pass
+            if error is not None and not ratelimit.is_throttled(error):
+                backend.errors += 1
+                backend.failures += 1
+                backend.failed_at = now
+                if backend.probing or (backend.failures >= CIRCUIT_FAILURES and not backend.open_until):
+                    backend.open_until = now + CIRCUIT_OPEN_SECONDS
+                    print(f"Backend {backend.name} failed {backend.failures} times in a row, "
+                          f"no requests for {CIRCUIT_OPEN_SECONDS:.0f}s")
+                backend.probing = False
+                return
+            if error is None:
+                latency = now - sent_at
+                backend.latency = latency if not backend.latency else (
+                    (1 - LATENCY_SMOOTHING) * backend.latency + LATENCY_SMOOTHING * latency)
+            # A throttled backend is still reachable; its limiter holds the requests back.
+            # Only the probe closes an open circuit, not requests sent before it opened.
+            backend.failures = 0
+            if backend.probing:
+                backend.open_until = 0.0
+                backend.probing = False
+
+    def _on_error(self, backend: Backend, sent_at: float, error: Exception, attempt: int,
+                  failed: List[Backend], sample: Optional[dict]) -> float:
+        """Handle a failed call and return how long to back off, 0 when failing over to another backend."""
+        headers = getattr(getattr(error, "response", None), "headers", None)
+        self._finish(backend, sent_at, headers, error)
+        delay = backend.limiter.record_error(error, attempt)
+        if backend not in failed:
+            failed.append(backend)
+        if sample is not None:
+            sample["retries"] = attempt + 1
+        if self._has_alternative(failed):
+            with self._lock:
+                self.failovers += 1
+            print(f"Azure OpenAI call to {backend.name} failed ({error.__class__.__name__}), "
+                  f"failing over to another deployment")
+            return 0.0
+        print(f"Azure OpenAI call failed ({error.__class__.__name__}), retry {attempt + 1} in {delay:.1f}s")
+        return delay
+
+    def call(self, send: Callable[[Backend], object], tokens: int, sample: Optional[dict] = None):
+        """Send a request to the best backend, failing over and retrying throttled and failed calls.
+
+        `send` receives the backend and must return a raw response
+        (with_raw_response) from its client, for its deployment; the parsed response is
+        returned. When a metrics sample dict is given, the time spent queued and backing
+        off, the number of retries and the backend that answered are added to it.
+        """
+        waited = 0.0
+        failed = []
+        try:
+            for attempt in range(ratelimit.MAX_RETRIES + 1):
+                backend = self._choose(tokens, failed)
+                start = time.perf_counter()
+                try:
+                    backend.limiter.acquire(tokens)
+                except BaseException:
+                    self._finish(backend, None)
+                    raise
+                waited += time.perf_counter() - start
+                sent_at = time.monotonic()
+                try:
+                    raw = send(backend)
+                except ratelimit.retryable_errors() as e:
+                    if attempt == ratelimit.MAX_RETRIES:
+                        self._finish(backend, sent_at, None, e)
+                        raise
+                    delay = self._on_error(backend, sent_at, e, attempt, failed, sample)
+                    waited += delay
+                    time.sleep(delay)
+                    continue
+                except BaseException:
+                    self._finish(backend, None)
+                    raise
+                self._finish(backend, sent_at, raw.headers)
+                backend.limiter.update_from_headers(raw.headers)
+                if sample is not None:
+                    sample["backend"] = backend.name
+                return raw.parse()
+        finally:
+            if sample is not None:
+                sample["queue_seconds"] = waited
+
+    async def call_async(self, send: Callable[[Backend], object], tokens: int, sample: Optional[dict] = None):
+        """Async version of call; `send` returns an awaitable raw response."""
+        waited = 0.0
+        failed = []
+        try:
+            for attempt in range(ratelimit.MAX_RETRIES + 1):
+                backend = self._choose(tokens, failed)
+                start = time.perf_counter()
+                try:
+                    await backend.limiter.acquire_async(tokens)
+                except BaseException:
+                    self._finish(backend, None)
+                    raise
+                waited += time.perf_counter() - start
+                sent_at = time.monotonic()
+                try:
+                    raw = await send(backend)
+                except ratelimit.retryable_errors() as e:
+                    if attempt == ratelimit.MAX_RETRIES:
+                        self._finish(backend, sent_at, None, e)
+                        raise
+                    delay = self._on_error(backend, sent_at, e, attempt, failed, sample)
+                    waited += delay
+                    await asyncio.sleep(delay)
+                    continue
+                except BaseException:
+                    self._finish(backend, None)
+                    raise
+                self._finish(backend, sent_at, raw.headers)
+                backend.limiter.update_from_headers(raw.headers)
+                if sample is not None:
+                    sample["backend"] = backend.name
+                return raw.parse()
+        finally:
+            if sample is not None:
+                sample["queue_seconds"] = waited
+
+    def stats(self) -> dict:
+        """Return the limiter totals of all backends plus one row per backend."""
+        rows = []
+        for backend in self.backends:
+            limiter_stats = backend.limiter.stats()
+            with self._lock:
+                now = time.monotonic()
+                rows.append({
+                    "name": backend.name,
+                    "state": backend.state(now),
+                    "in_flight": backend.in_flight,
+                    "latency_seconds": round(backend.latency, 3),
+                    "requests": backend.requests,
+                    "errors": backend.errors,
+                    "remaining_tokens": backend.remaining_tokens,
+                    **limiter_stats,
+                })
+        return {
+            "queue_depth": sum(row["queue_depth"] for row in rows),
+            "retries": sum(row["retries"] for row in rows),
+            "throttled": sum(row["throttled"] for row in rows),
+            "paused_for": min(row["paused_for"] for row in rows),
+            "failovers": self.failovers,
+            "backends": rows,
+        }
+
+
+def load_backends(config: str = BACKENDS) -> List[Backend]:
+    """Return the backends described by AZURE_OPENAI_BACKENDS, or the single configured deployment."""
+    if not config.strip():
+        return [Backend("default", clients.endpoint, clients.model, clients.api_key, clients.api_version,
+                        limiter=ratelimit.get_limiter(), client_factory=clients.openai_client)]
+    backends = []
+    for number, entry in enumerate(json.loads(config), 1):
+        backends.append(Backend(
+            entry.get("name") or f"backend{number}",
+            entry["endpoint"],
+            entry.get("deployment") or clients.model,
+            entry.get("api_key") or os.getenv(entry.get("api_key_env") or "", "") or clients.api_key,
+            entry.get("api_version") or clients.api_version,
+            weight=entry.get("weight", 1),
+            limiter=ratelimit.RateLimiter(int(entry.get("requests_per_minute", 0)),
+                                          int(entry.get("tokens_per_minute", 0))),
+        ))
+    return backends
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> Router:
+    """Return the router shared by every session in this process."""
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = Router(load_backends())
+        return _router
@@ -0,0 +1,113 @@
+"""Coalescing of identical requests that are in flight at the same time.
+
+When a snippet is shared, several sessions often run the same action on the same
+code within seconds. The response cache only helps once the first answer is in, so
+each of them paid for its own completion. Requests are now keyed like the cache
+(action, system prompt, task description, code and history): the first one leads a
+Flight and calls the service, and identical requests arriving while it runs join
+the flight instead. They receive the leader's streamed updates as they are produced
+and then its result, or the error the service returned. When the leader is cancelled
+instead, for example with the batch it belongs to, the followers join again and one
+of them leads the request. This works across the sessions, jobs and API requests of
+a process.
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "true").lower() == "true"
+
+
+class Flight:
+    """One upstream request and the callers waiting for its (feedback, code) result.
+
+    The leader uses the flight as a context manager around the request: it publishes
+    partial output and sets the result. Leaving the block with an error fails the
+    flight with it; leaving it without a result otherwise, such as when the leader is
+    cancelled, abandons the flight and the followers get None.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self._future = Future()
+        self._partial: Optional[Tuple[str, str]] = None
+        self._subscribers: List[Callable[[str, str], None]] = []
+        self._lock = threading.Lock()
+
+    def publish(self, feedback: str, code: str):
+        """Pass the leader's partial output to the followers that stream."""
+        # Called under the lock so every follower sees the updates in order
+        with self._lock:
+            self._partial = (feedback, code)
+            for on_update in self._subscribers:
+                try:
+                    on_update(feedback, code)
+                except Exception as e:
+                    print(f"Coalesced request update failed: {e}")
+
+    def set_result(self, result: Tuple[str, str]):
+        self._future.set_result(result)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Unregistered first so followers that join again do not find this flight
+        with _flights_lock:
+            if _flights.get(self.key) is self:
+                del _flights[self.key]
+        if not self._future.done():
+            if isinstance(exc, Exception):
+                self._future.set_exception(exc)
+            else:
+                # Cancelled or interrupted: no answer to pass on, the followers retry
+                self._future.set_result(None)
+        return False
+
+    def wait(self, on_update: Optional[Callable[[str, str], None]] = None) -> Optional[Tuple[str, str]]:
+        """Block until the leader's result, passing its partial output to on_update meanwhile.
+
+        Returns None when the leader abandoned the flight; the caller should join again.
+        """
+        if on_update is not None:
+            with self._lock:
+                if self._partial is not None:
+                    on_update(*self._partial)
+                self._subscribers.append(on_update)
+        try:
+            result = self._future.result()
+        finally:
+            if on_update is not None:
+                with self._lock:
+                    self._subscribers.remove(on_update)
+        if on_update is not None and result is not None:
+            on_update(*result)
+        return result
+
+    async def wait_async(self) -> Optional[Tuple[str, str]]:
+        """Wait for the leader's result without blocking the event loop, or None like wait."""
+        # Shielded so a cancelled follower does not cancel the result for the others
+        return await asyncio.shield(asyncio.wrap_future(self._future))
+
+
+_flights: Dict[str, Flight] = {}
+_flights_lock = threading.Lock()
+
+
+def join(key: str) -> Tuple[Flight, bool]:
+    """Return the flight for a request key and whether the caller leads it.
+
+    The leader must run the request inside `with flight:` and call set_result; the
+    others wait for it and join again when the wait returns None. With
+    COALESCE_REQUESTS off every caller leads its own flight.
+    """
+    if not COALESCE_REQUESTS:
+        return Flight(key), True
+    with _flights_lock:
+        flight = _flights.get(key)
+        if flight is not None:
+            return flight, False
+        flight = _flights[key] = Flight(key)
+        return flight, True
@@ -0,0 +1,101 @@
+"""Uploads of user files to the Azure Storage container.
+
+Files are streamed to blob storage straight from the upload's in-memory buffer,
+without temporary copies on disk. Files over the single-put size are sent as
+blocks in parallel, blobs whose content is unchanged are skipped by comparing
+MD5 hashes, and several files are uploaded concurrently.
+"""
+import hashlib
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+import clients
+
+# Blocks uploaded in parallel for one large file, and files uploaded in parallel
+UPLOAD_MAX_CONCURRENCY = int(os.getenv("UPLOAD_MAX_CONCURRENCY", "4"))
+UPLOAD_FILES_CONCURRENCY = int(os.getenv("UPLOAD_FILES_CONCURRENCY", "4"))
+
+
+class MemoryviewStream(io.RawIOBase):
+    """Seekable read-only stream over a memoryview, so the SDK reads blocks without copying the whole buffer."""
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, min(offset, len(self._view)))
+        return self._position
+
+    def readinto(self, buffer):
+        size = min(len(buffer), len(self._view) - self._position)
+        buffer[:size] = self._view[self._position:self._position + size]
+        self._position += size
+        return size
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(len(self._view), self._position + size)
+        data = self._view[self._position:end].tobytes()
+        self._position = end
+        return data
+
+
+def upload_file(name: str, data: memoryview) -> bool:
+    """Upload data as blob `name` unless the blob already has the same content.
+
+    Returns True when the blob was uploaded and False when it was unchanged.
+    """
+    # Imported here so the Azure SDK only loads once a file is uploaded (see clients.py)
+    from azure.core.exceptions import ResourceNotFoundError
+    from azure.storage.blob import ContentSettings
+
+    data = memoryview(data).cast("B")
+    content_md5 = hashlib.md5(data).digest()
+    blob_client = clients.container_client().get_blob_client(name)
+    try:
+        properties = blob_client.get_blob_properties()
+        if properties.content_settings.content_md5 == content_md5:
+            print(f"Skipping unchanged blob {name}")
+            return False
+    except ResourceNotFoundError:
+        pass
+
+    blob_client.upload_blob(
+        MemoryviewStream(data),
+        length=len(data),
+        overwrite=True,
+        max_concurrency=UPLOAD_MAX_CONCURRENCY,
+        # Block uploads have no service-computed MD5, so store ours for the next comparison
+        content_settings=ContentSettings(content_md5=content_md5),
+    )
+    return True
+
+
+def upload_files(files: Dict[str, memoryview]) -> Dict[str, str]:
+    """Upload several files concurrently.
+
+    Returns {name: "uploaded", "unchanged" or the error message}.
+    """
+    def upload(name: str) -> str:
+        try:
+            return "uploaded" if upload_file(name, files[name]) else "unchanged"
+        except Exception as e:
+            return str(e)
+
+    with ThreadPoolExecutor(max_workers=max(1, UPLOAD_FILES_CONCURRENCY)) as pool:
+        return dict(zip(files, pool.map(upload, files)))
@@ -0,0 +1,82 @@
+"""Pre-flight token budget of completion requests.
+
+Every request used to ask for its action's fixed max_tokens, 8000 for most actions.
+The rate limiter, like the service, reserves the prompt tokens plus max_tokens of
+the tokens-per-minute quota for each request, so a response of a few hundred tokens
+held the quota of 8000 and fewer requests fit in a minute. A prompt too large for
+the model's context only failed after a round trip to the service.
+
+plan() runs before a request is sent. It counts the prompt tokens locally, raises
+PromptTooLargeError when the prompt leaves no room for a response, and picks the
+request's max_tokens. The action's max_tokens, capped to what is left of the
+context, is the ceiling. Once the action has MAX_TOKENS_MIN_SAMPLES recent
+completions in the metrics, the limit is learned from them: completion tokens grow
+with the size of the prompt (the task and the code), so the ratio of the two is
+taken at MAX_TOKENS_QUANTILE, scaled to this request's input and given a
+MAX_TOKENS_MARGIN. The engine retries a response cut off by a learned limit once
+with the ceiling.
+"""
+import os
+from typing import Optional
+
+import metrics
+from chunking import count_tokens
+
+# Context window of the deployed model, prompt and completion together
+CONTEXT_TOKENS = int(os.getenv("AZURE_OPENAI_CONTEXT_TOKENS", "128000"))
+ADAPTIVE_MAX_TOKENS = os.getenv("ADAPTIVE_MAX_TOKENS", "true").lower() == "true"
+# Completions of an action needed before its limit is learned
+MAX_TOKENS_MIN_SAMPLES = int(os.getenv("MAX_TOKENS_MIN_SAMPLES", "20"))
+MAX_TOKENS_QUANTILE = float(os.getenv("MAX_TOKENS_QUANTILE", "0.99"))
+MAX_TOKENS_MARGIN = float(os.getenv("MAX_TOKENS_MARGIN", "1.25"))
+# Smallest max_tokens a request is sent with; a prompt leaving less room is rejected
+MIN_MAX_TOKENS = 256
+# Added to the input size so short prompts with long answers do not give huge ratios
+INPUT_BASE_TOKENS = 256
+
+
+class PromptTooLargeError(ValueError):
+    """The prompt does not leave room for a response in the model's context."""
+
+
+def ceiling(max_tokens: int, prompt_tokens: int) -> int:
+    """Return the largest max_tokens a request may use: the action's, capped by the context."""
+    return min(max_tokens, CONTEXT_TOKENS - prompt_tokens)
+
+
+def learned_max_tokens(action: str, input_tokens: int) -> Optional[int]:
+    """Return the max_tokens learned from the action's recent completions, or None without enough of them."""
+    samples = [s for s in metrics.recorder.samples(action)
+               if not s.get("cache_hit") and not s.get("error")
+               and s.get("completion_tokens") and s.get("input_tokens") is not None]
+    if len(samples) < MAX_TOKENS_MIN_SAMPLES:
+        return None
+    ratios = [s["completion_tokens"] / (s["input_tokens"] + INPUT_BASE_TOKENS) for s in samples]
+    ratio = metrics.percentile(ratios, MAX_TOKENS_QUANTILE)
+    return int(ratio * (input_tokens + INPUT_BASE_TOKENS) * MAX_TOKENS_MARGIN)
+
+
+def plan(action: str, request: dict, sample: dict) -> int:
+    """Set the request's max_tokens and return the quota it reserves: prompt tokens plus max_tokens.
+
+    The last message of a request is the prompt holding the task and the code; its size
+    is the input the learned limit scales with. The counts are recorded in the metrics
+    sample, which is also what later requests learn from.
+    """
+    counts = [count_tokens(message["content"] or "") for message in request["messages"]]
+    prompt_tokens = sum(counts)
+    limit = ceiling(request["max_tokens"], prompt_tokens)
+    if limit < MIN_MAX_TOKENS:
+        raise PromptTooLargeError(
+            f"The prompt for {action} has about {prompt_tokens} tokens, which leaves no room for a response "
+            f"in the model's context of {CONTEXT_TOKENS} tokens. Shorten the code or task description."
+        )
+    if ADAPTIVE_MAX_TOKENS:
+        learned = learned_max_tokens(action, counts[-1])
+        if learned is not None:
+            limit = max(MIN_MAX_TOKENS, min(limit, learned))
+    request["max_tokens"] = limit
+    sample["prompt_tokens"] = prompt_tokens
+    sample["input_tokens"] = counts[-1]
+    sample["max_tokens"] = limit
+    return prompt_tokens + limit